@@ -0,0 +1,394 @@
+import os
+import io
+import sys
+import argparse
+import json
+import re
+import time
+import random
+import platform
+import statistics
+import resource
+import subprocess
+import tempfile
+import importlib.util
+from collections import Counter
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.append(os.path.join(ROOT_DIR, "preprocess", "morphological-analysis", "scripts"))
+sys.path.append(os.path.join(ROOT_DIR, "fine-tuning", "scripts"))
+sys.path.append(os.path.join(ROOT_DIR, "preprocess", "common", "scripts"))
+
+STAGES = ["marc_ja_clean", "marc_ja_output", "marc_ja_output_spill", "marc_ja_output_hash",
+          "tokenize_char", "tokenize_stub", "jsquad_align", "score_results"]
+
+# a stage that fails to import one of these is skipped (reported with this exit status) instead of failing
+OPTIONAL_MODULES = {"bs4", "zenhan", "numpy"}
+SKIPPED_EXIT_STATUS = 3
+
+# the columns analyzed for each json dataset
+JSON_DATASETS = {"jsts-v1.3": ["sentence1", "sentence2"],
+                 "jnli-v1.3": ["sentence1", "sentence2"],
+                 "jcommonsenseqa-v1.3": ["question", "choice0", "choice1", "choice2", "choice3", "choice4"]}
+
+
+def get_stub_analyzer_class():
+    from morphological_analyzer import MorphologicalAnalyzer
+
+    # splits at changes of the character type, as a rough stand-in for MeCab/Juman++ that needs no dictionary
+    class StubMorphologicalAnalyzer(MorphologicalAnalyzer):
+        TOKEN = re.compile(r"[一-鿿々]+|[ぁ-ゟ]+|[゠-ヿー]+|[A-Za-z0-9Ａ-Ｚａ-ｚ０-９]+|\S")
+
+        def get_surfaces(self, string):
+            return self.TOKEN.findall(string)
+
+    return StubMorphologicalAnalyzer
+
+
+def load_json_lines(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def get_strings(args):
+    strings = []
+    for dirname, column_names in JSON_DATASETS.items():
+        for row in load_json_lines(os.path.join(args.data_dir, dirname, "valid-v1.3.json")):
+            strings.extend(row[column_name] for column_name in column_names)
+    return strings
+
+
+def get_synthetic_marc_rows(data_dir, row_num, seed=1):
+    # amazon review tsv rows built from JGLUE sentences with some html and hankaku characters
+    rng = random.Random(seed)
+    sentences = [row["sentence1"] for row in load_json_lines(os.path.join(data_dir, "jsts-v1.3", "valid-v1.3.json"))]
+    rows = []
+    for idx in range(row_num):
+        text = "<br />".join(rng.choice(sentences) for _ in range(rng.randint(1, 5)))
+        if idx % 50 == 0:
+            text = "This review is written in English only."
+        elif idx % 7 == 0:
+            text += "ｶﾞｯｶﾘ"
+        rows.append(["JP", str(idx), f"R{idx:012d}", "P", "PP", "title", "category", str(rng.randint(1, 5)),
+                     "0", "0", "N", "Y", "headline", text, "2015-01-01"])
+    return rows
+
+
+def get_batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def run_batches(batches, func):
+    latencies = []
+    row_num, char_num = 0, 0
+    start_time = time.perf_counter()
+    for batch in batches:
+        batch_start_time = time.perf_counter()
+        chars = func(batch)
+        latencies.append(time.perf_counter() - batch_start_time)
+        row_num += len(batch)
+        char_num += chars
+    return time.perf_counter() - start_time, row_num, char_num, latencies
+
+
+def load_marc_ja():
+    spec = importlib.util.spec_from_file_location("marc_ja", os.path.join(ROOT_DIR, "preprocess", "marc-ja", "scripts", "marc-ja.py"))
+    marc_ja = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(marc_ja)
+    return marc_ja
+
+
+def run_marc_ja_clean(args, scale):
+    marc_ja = load_marc_ja()
+    rows = get_synthetic_marc_rows(args.data_dir, args.marc_ja_rows * scale)
+
+    def func(batch):
+        marc_ja.clean_rows(batch, positive_negative=True, max_char_length=500, h2z=True)
+        return sum(len(row[13]) for row in batch)
+
+    return run_batches(get_batches(rows, args.batch_size), func)
+
+
+# filter/label conv lists for the valid/test instances of the random.seed(1) shuffle, as the shipped lists are
+def get_synthetic_review_id_lists(instances, split_ratio, get_split_eval_type_func):
+    order = list(range(len(instances)))
+    random.seed(1)
+    random.shuffle(order)
+    get_eval_type = get_split_eval_type_func(len(instances), split_ratio)
+
+    filter_review_id_list, label_conv_review_id_list = {"valid": set(), "test": set()}, {"valid": {}, "test": {}}
+    for idx, instance_idx in enumerate(order):
+        eval_type = get_eval_type(idx)
+        if eval_type == "train":
+            continue
+        instance = instances[instance_idx]
+        if idx % 20 == 0:
+            filter_review_id_list[eval_type].add(instance["review_id"])
+        elif idx % 20 == 1:
+            label_conv_review_id_list[eval_type][instance["review_id"]] = \
+                "negative" if instance["label"] == "positive" else "positive"
+    return filter_review_id_list, label_conv_review_id_list
+
+
+# the split/filter/output pass of marc-ja.py on cleaned instances, with each --split-method
+def run_marc_ja_output(args, scale, split_method):
+    marc_ja = load_marc_ja()
+    from instrumentation import Instrumentation
+
+    rows = get_synthetic_marc_rows(args.data_dir, args.marc_ja_rows * scale)
+    instances, _ = marc_ja.clean_rows(rows, positive_negative=True, max_char_length=500, h2z=True)
+    instances = [instance for instance in instances if instance is not None]
+    split_ratio = [0.94, 0.03, 0.03]
+    filter_review_id_list, label_conv_review_id_list = get_synthetic_review_id_lists(
+        instances, split_ratio, marc_ja.get_split_eval_type_func)
+    instrumentation = Instrumentation("marc-ja")
+
+    def func(batch):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_args = argparse.Namespace(output_dir=tmp_dir, version=1.0, split_ratio=split_ratio,
+                                             output_testset=True, shard_size=None, shard_compression="gzip")
+            if split_method == "hash":
+                marc_ja.output_data_by_hash(iter(batch), output_args, filter_review_id_list,
+                                            label_conv_review_id_list, instrumentation)
+            elif split_method == "spill":
+                # small runs, so that the sorted runs are merged even at 1x
+                spilled_instances = marc_ja.SpilledInstances(
+                    iter(batch), tmp_dir=tmp_dir, run_size=1024 * 1024,
+                    watched_review_ids=marc_ja.get_watched_review_ids(filter_review_id_list,
+                                                                      label_conv_review_id_list))
+                spilled_instances.shuffle(1)
+                marc_ja.output_data(spilled_instances, output_args, filter_review_id_list,
+                                    label_conv_review_id_list, instrumentation)
+                spilled_instances.close()
+            else:
+                random.seed(1)
+                random.shuffle(batch)
+                marc_ja.output_data(batch, output_args, filter_review_id_list, label_conv_review_id_list,
+                                    instrumentation)
+        return sum(len(instance["sentence"]) for instance in batch)
+
+    # the whole split is one pass, so it is measured as one batch
+    return run_batches([instances], func)
+
+
+def run_tokenize(args, scale, analyzer_class, analyzer):
+    morphological_analyzer = analyzer_class(analyzer)
+    strings = get_strings(args) * scale
+
+    def func(batch):
+        morphological_analyzer.get_tokenized_strings(batch)
+        return sum(len(string) for string in batch)
+
+    return run_batches(get_batches(strings, args.batch_size), func)
+
+
+def run_jsquad_align(args, scale):
+    from morphological_analyzer import MorphologicalAnalyzer
+    from apply_morphological_analysis import process_squad_article
+
+    with open(os.path.join(args.data_dir, "jsquad-v1.3", "valid-v1.3.json"), "r", encoding="utf-8") as f:
+        articles = json.load(f)["data"]
+    morphological_analyzer = MorphologicalAnalyzer("char")
+    stats = Counter()
+
+    def func(batch):
+        for idx in batch:
+            article = json.loads(json.dumps(articles[idx % len(articles)]))
+            process_squad_article(article, morphological_analyzer, stats)
+        return sum(len(paragraph["context"]) for idx in batch for paragraph in articles[idx % len(articles)]["paragraphs"])
+
+    # one article per batch: an article is the unit of work of the squad_json processing
+    return run_batches(get_batches(list(range(len(articles) * scale)), 1), func)
+
+
+def run_score_results(args, scale):
+    from generate_results import iter_rows, get_eval_string, compute_metrics
+
+    rows = load_json_lines(os.path.join(args.data_dir, "jsts-v1.3", "valid-v1.3.json")) * scale
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_file = os.path.join(tmp_dir, "input.json")
+        system_predict_txt = os.path.join(tmp_dir, "predict_results.txt")
+        with open(input_file, "w", encoding="utf-8") as f:
+            for row in rows:
+                print(json.dumps(row, ensure_ascii=False), file=f)
+        with open(system_predict_txt, "w", encoding="utf-8") as f:
+            print("index\tprediction", file=f)
+            for idx, row in enumerate(rows):
+                print(f"{idx}\t{row['label'] + rng.gauss(0, 1):.3f}", file=f)
+
+        with open(system_predict_txt, "r", encoding="utf-8") as system_f, open(input_file, "r", encoding="utf-8") as input_f:
+            all_rows = list(iter_rows(system_f, input_f, "json"))
+
+    system_predicts, golds = [], []
+
+    def func(batch):
+        for input_data, system_predict in batch:
+            get_eval_string(input_data, system_predict, "regression", "sentence-pair")
+            system_predicts.append(float(system_predict))
+            golds.append(float(input_data["label"]))
+        return sum(len(input_data["sentence1"]) + len(input_data["sentence2"]) for input_data, _ in batch)
+
+    elapsed, row_num, char_num, latencies = run_batches(get_batches(all_rows, args.batch_size), func)
+    start_time = time.perf_counter()
+    compute_metrics(system_predicts, golds, "regression")
+    elapsed += time.perf_counter() - start_time
+    return elapsed, row_num, char_num, latencies
+
+
+def get_percentile(sorted_values, q):
+    if len(sorted_values) == 0:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))]
+
+
+# runs one (stage, scale) in this process and prints the result as json
+def run_stage(args):
+    if args.run_stage == "marc_ja_clean":
+        elapsed, row_num, char_num, latencies = run_marc_ja_clean(args, args.scale)
+    elif args.run_stage == "marc_ja_output":
+        elapsed, row_num, char_num, latencies = run_marc_ja_output(args, args.scale, "shuffle")
+    elif args.run_stage == "marc_ja_output_spill":
+        elapsed, row_num, char_num, latencies = run_marc_ja_output(args, args.scale, "spill")
+    elif args.run_stage == "marc_ja_output_hash":
+        elapsed, row_num, char_num, latencies = run_marc_ja_output(args, args.scale, "hash")
+    elif args.run_stage == "tokenize_char":
+        from morphological_analyzer import MorphologicalAnalyzer
+        elapsed, row_num, char_num, latencies = run_tokenize(args, args.scale, MorphologicalAnalyzer, "char")
+    elif args.run_stage == "tokenize_stub":
+        elapsed, row_num, char_num, latencies = run_tokenize(args, args.scale, get_stub_analyzer_class(), "stub")
+    elif args.run_stage == "jsquad_align":
+        elapsed, row_num, char_num, latencies = run_jsquad_align(args, args.scale)
+    elif args.run_stage == "score_results":
+        elapsed, row_num, char_num, latencies = run_score_results(args, args.scale)
+
+    latencies = sorted(latencies)
+    result = {"rows": row_num,
+              "chars": char_num,
+              "elapsed_sec": elapsed,
+              "rows_per_sec": row_num / elapsed if elapsed > 0 else float("nan"),
+              "chars_per_sec": char_num / elapsed if elapsed > 0 else float("nan"),
+              # ru_maxrss is in kilobytes on linux and in bytes on macOS
+              "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform != "darwin" else 1024 * 1024),
+              "latency_ms": {f"p{q}": get_percentile(latencies, q) * 1000 for q in (50, 90, 99)}}
+    print(json.dumps(result))
+
+
+# the repeated runs of a (stage, scale) are summarized as timeit does: the throughput of the fastest run,
+# since slower runs are mostly slowed down by other load on the machine, and the median of the others
+def get_repeated_result(runs):
+    fastest_run = min(runs, key=lambda run: run["elapsed_sec"])
+    result = {name: fastest_run[name] for name in ("rows", "chars", "elapsed_sec", "rows_per_sec", "chars_per_sec")}
+    result["peak_rss_mb"] = statistics.median(run["peak_rss_mb"] for run in runs)
+    result["latency_ms"] = {q: statistics.median(run["latency_ms"][q] for run in runs) for q in runs[0]["latency_ms"]}
+    result["rows_per_sec_runs"] = [run["rows_per_sec"] for run in runs]
+    return result
+
+
+# keys are the (stage, scale) that were requested in this run, so that a baseline key that is missing from
+# the results (a stage that crashed or was skipped) is a failure
+def compare_with_baseline(results, baseline, tolerance, keys):
+    regressions = []
+    for key in keys:
+        if key not in baseline:
+            continue
+        if key not in results:
+            regressions.append(f"{key}: in the baseline but not measured")
+            continue
+        result = results[key]
+        if result["rows_per_sec"] < baseline[key]["rows_per_sec"] * (1 - tolerance):
+            regressions.append(f"{key}: rows/s {result['rows_per_sec']:.1f} < baseline {baseline[key]['rows_per_sec']:.1f}")
+        if result["peak_rss_mb"] > baseline[key]["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{key}: peak rss {result['peak_rss_mb']:.1f} MB > baseline {baseline[key]['peak_rss_mb']:.1f} MB")
+    return regressions
+
+
+def main(args):
+    results, skipped, failed = {}, {}, {}
+    keys = [f"{stage}@{scale}x" for stage in args.stages for scale in args.scales]
+    for stage in args.stages:
+        for scale in args.scales:
+            key = f"{stage}@{scale}x"
+            # each stage runs in a fresh process, so that its peak rss is measured separately
+            cmds = [sys.executable, os.path.abspath(__file__),
+                    "--run-stage", stage, "--scale", str(scale),
+                    "--data-dir", args.data_dir,
+                    "--batch-size", str(args.batch_size),
+                    "--marc-ja-rows", str(args.marc_ja_rows)]
+            runs = []
+            for _ in range(args.repeats):
+                completed = subprocess.run(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if completed.returncode != 0:
+                    break
+                runs.append(json.loads(completed.stdout))
+            stderr = completed.stderr.decode("utf-8").strip()
+            if completed.returncode == SKIPPED_EXIT_STATUS:
+                skipped[key] = stderr
+                print(f"{key}: skipped ({stderr})", file=sys.stderr)
+                continue
+            elif completed.returncode != 0:
+                failed[key] = stderr
+                print(f"{key}: failed\n{stderr}", file=sys.stderr)
+                continue
+            results[key] = get_repeated_result(runs)
+            print("{}: {:.1f} rows/s, {:.1f} chars/s, peak rss {:.1f} MB, p50/p90/p99 {:.2f}/{:.2f}/{:.2f} ms".format(
+                key, results[key]["rows_per_sec"], results[key]["chars_per_sec"], results[key]["peak_rss_mb"],
+                *results[key]["latency_ms"].values()), file=sys.stderr)
+
+    output = {"environment": {"python": platform.python_version(), "platform": platform.platform(),
+                              "cpu_count": os.cpu_count()},
+              "repeats": args.repeats,
+              "results": results,
+              "skipped": skipped,
+              "failed": failed}
+    with open(args.output_file, "w") as f:
+        json.dump(output, f, indent=2)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_with_baseline(results, baseline, args.tolerance, keys)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.stdin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+
+    parser = argparse.ArgumentParser(description="benchmark the preprocessing and evaluation pipelines.")
+    parser.add_argument("--data-dir", type=str, default=os.path.join(ROOT_DIR, "datasets"), help="data dir")
+    parser.add_argument("--stages", nargs="*", choices=STAGES, default=STAGES, help="stages to run")
+    parser.add_argument("--scales", nargs="*", type=int, default=[1, 10, 100], help="scales of the corpora")
+    parser.add_argument("--batch-size", type=int, default=100, help="number of rows per measured batch")
+    parser.add_argument("--marc-ja-rows", type=int, default=5000, help="number of synthetic MARC-ja rows at 1x")
+    parser.add_argument("--repeats", type=int, default=5, help="number of runs of each stage, whose fastest is compared")
+    parser.add_argument("--output-file", type=str, default="benchmark_results.json", help="output json file")
+    parser.add_argument("--baseline", type=str, default=None, help="baseline json file to compare with")
+    parser.add_argument("--save-baseline", type=str, default=None, help="also save the results as a baseline json file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression of throughput and peak rss")
+    parser.add_argument("--run-stage", choices=STAGES, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--scale", type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage is not None:
+        try:
+            run_stage(args)
+        except ModuleNotFoundError as e:
+            if e.name not in OPTIONAL_MODULES:
+                raise
+            print(f"{e.name} is not installed", file=sys.stderr)
+            sys.exit(SKIPPED_EXIT_STATUS)
+    else:
+        main(args)
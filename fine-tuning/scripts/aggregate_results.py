@@ -0,0 +1,210 @@
+import sys
+import io
+import os
+import argparse
+import glob
+import json
+import csv
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from generate_results import compute_metrics, get_metric_keys
+
+
+def load_input_rows(args):
+    with open(args.input_file, "r", encoding="utf-8") as input_f:
+        if args.input_file_type == "json":
+            return [json.loads(line) for line in input_f]
+        else:
+            return list(csv.DictReader(input_f))
+
+
+# predictions and gold labels as the comparable keys of generate_results.py
+def load_metric_keys(system_predict_txt, input_rows, args):
+    with open(system_predict_txt, "r", encoding="utf-8") as system_f:
+        next(system_f)
+        system_predicts = [row[1] for row in csv.reader(system_f, delimiter="\t")]
+    if len(system_predicts) != len(input_rows):
+        raise ValueError(f"{system_predict_txt} has {len(system_predicts)} predictions, "
+                         f"but {args.input_file} has {len(input_rows)} examples")
+
+    metric_keys = [get_metric_keys(input_data, system_predict, args.classification_type, args.task_type)
+                   for input_data, system_predict in zip(input_rows, system_predicts)]
+    return [system_predict for system_predict, _ in metric_keys], [gold for _, gold in metric_keys]
+
+
+def get_metric_names(classification_type):
+    return ["pearson", "spearman"] if classification_type == "regression" else ["accuracy"]
+
+
+def get_row_ranks(values):
+    # average ranks for ties along the last axis
+    sorter = np.argsort(values, axis=-1, kind="mergesort")
+    sorted_values = np.take_along_axis(values, sorter, axis=-1)
+    n = values.shape[-1]
+    positions = np.broadcast_to(np.arange(n), values.shape)
+    is_new = np.concatenate((np.ones(values.shape[:-1] + (1,), dtype=bool),
+                             sorted_values[..., 1:] != sorted_values[..., :-1]), axis=-1)
+    # first and last position of each run of ties
+    group_starts = np.maximum.accumulate(np.where(is_new, positions, 0), axis=-1)
+    is_last = np.concatenate((is_new[..., 1:], np.ones(values.shape[:-1] + (1,), dtype=bool)), axis=-1)
+    group_ends = np.flip(np.minimum.accumulate(np.flip(np.where(is_last, positions, n), axis=-1), axis=-1), axis=-1)
+    sorted_ranks = 0.5 * (group_starts + group_ends) + 1
+    ranks = np.empty_like(sorted_ranks)
+    np.put_along_axis(ranks, sorter, sorted_ranks, axis=-1)
+    return ranks
+
+
+def get_row_pearsons(x, y):
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (x * y).sum(axis=-1) / np.sqrt((x * x).sum(axis=-1) * (y * y).sum(axis=-1))
+
+
+# metrics of all the bootstrap samples at once: indices is (sample num, example num)
+def get_bootstrap_metrics(system_predicts, golds, indices, classification_type):
+    if classification_type == "regression":
+        x, y = system_predicts[indices], golds[indices]
+        return {"pearson": get_row_pearsons(x, y),
+                "spearman": get_row_pearsons(get_row_ranks(x), get_row_ranks(y))}
+    else:
+        return {"accuracy": (system_predicts == golds)[indices].mean(axis=-1)}
+
+
+def get_bootstrap_indices(example_num, args):
+    # every run uses the same samples, so that the runs can be compared pairwise
+    rng = np.random.default_rng(args.seed)
+    return rng.integers(0, example_num, size=(args.bootstrap_samples, example_num))
+
+
+# shared by the worker processes
+shared_input_rows = None
+shared_args = None
+
+
+def init_worker(input_rows, args):
+    global shared_input_rows, shared_args
+    shared_input_rows = input_rows
+    shared_args = args
+
+
+def evaluate_run(system_predict_txt):
+    args = shared_args
+    system_predicts, golds = load_metric_keys(system_predict_txt, shared_input_rows, args)
+
+    metrics = compute_metrics(system_predicts, golds, args.classification_type)
+
+    if args.classification_type == "regression":
+        system_predicts = np.asarray(system_predicts, dtype=np.float64)
+        gold_array = np.asarray(golds, dtype=np.float64)
+    else:
+        # labels are compared as integer codes
+        label_ids = {label: idx for idx, label in enumerate(sorted(set(golds), key=str))}
+        system_predicts = np.array([label_ids.get(system_predict, -1) for system_predict in system_predicts])
+        gold_array = np.array([label_ids[gold] for gold in golds])
+
+    bootstrap_metrics = {metric_name: [] for metric_name in get_metric_names(args.classification_type)}
+    indices = get_bootstrap_indices(len(golds), args)
+    for start in range(0, len(indices), args.bootstrap_chunk_size):
+        chunk_metrics = get_bootstrap_metrics(system_predicts, gold_array,
+                                              indices[start:start + args.bootstrap_chunk_size],
+                                              args.classification_type)
+        for metric_name, values in chunk_metrics.items():
+            bootstrap_metrics[metric_name].append(values)
+
+    return system_predict_txt, metrics, {metric_name: np.concatenate(values)
+                                         for metric_name, values in bootstrap_metrics.items()}
+
+
+def get_system_predict_txts(patterns):
+    system_predict_txts = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "predict_results_*.txt")
+        system_predict_txts.extend(sorted(glob.glob(pattern, recursive=True)))
+    # keep the first occurrence of each file
+    return list(dict.fromkeys(system_predict_txts))
+
+
+# paired bootstrap tests between all the runs: for each pair of a run and a lower ranked run, how often the lower
+# ranked run is at least as good on the same samples
+def write_pairwise_tests(results, primary_metric_name, output_file):
+    bootstrap_metrics = np.stack([result[2][primary_metric_name] for result in results])
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write("\t".join(["run", "other_run", f"{primary_metric_name}_diff", "p_value"]) + "\n")
+        for idx, (system_predict_txt, metrics, _) in enumerate(results):
+            p_values = np.mean(bootstrap_metrics[idx + 1:] >= bootstrap_metrics[idx], axis=-1)
+            for (other_system_predict_txt, other_metrics, _), p_value in zip(results[idx + 1:], p_values):
+                diff = metrics[primary_metric_name] - other_metrics[primary_metric_name]
+                f.write("\t".join([system_predict_txt, other_system_predict_txt,
+                                   "{:.4f}".format(diff), "{:.4f}".format(p_value)]) + "\n")
+
+
+def main(args):
+    input_rows = load_input_rows(args)
+    system_predict_txts = get_system_predict_txts(args.system_predict_txts)
+    if len(system_predict_txts) == 0:
+        raise ValueError(f"no prediction files found: {args.system_predict_txts}")
+
+    # the gold file is parsed once and shared by the workers
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(input_rows, args)) as executor:
+        results = list(executor.map(evaluate_run, system_predict_txts))
+
+    metric_names = get_metric_names(args.classification_type)
+    primary_metric_name = metric_names[0]
+    results.sort(key=lambda result: -np.nan_to_num(result[1][primary_metric_name], nan=-np.inf))
+    best_bootstrap_metric = results[0][2][primary_metric_name]
+
+    alpha = (1.0 - args.confidence) / 2
+    columns = ["rank", "run"]
+    for metric_name in metric_names:
+        columns.extend([metric_name, f"{metric_name}_ci_low", f"{metric_name}_ci_high"])
+    columns.extend(["p_vs_best", "num"])
+
+    writer = sys.stdout if args.output_file is None else open(args.output_file, "w", encoding="utf-8")
+    writer.write("\t".join(columns) + "\n")
+    for rank, (system_predict_txt, metrics, bootstrap_metrics) in enumerate(results, 1):
+        values = [str(rank), system_predict_txt]
+        for metric_name in metric_names:
+            ci_low, ci_high = np.nanquantile(bootstrap_metrics[metric_name], [alpha, 1.0 - alpha])
+            values.extend(["{:.4f}".format(metrics[metric_name]), "{:.4f}".format(ci_low), "{:.4f}".format(ci_high)])
+        # paired bootstrap test: how often this run is at least as good as the best run on the same samples
+        if rank == 1:
+            values.append("-")
+        else:
+            p_value = np.mean(bootstrap_metrics[primary_metric_name] >= best_bootstrap_metric)
+            values.append("{:.4f}".format(p_value))
+        values.append(str(metrics["num"]))
+        writer.write("\t".join(values) + "\n")
+    if writer is not sys.stdout:
+        writer.close()
+
+    if args.pairwise_file is not None:
+        write_pairwise_tests(results, primary_metric_name, args.pairwise_file)
+
+
+if __name__ == "__main__":
+    sys.stdin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+
+    parser = argparse.ArgumentParser(description="aggregate the results of many runs into a leaderboard")
+    parser.add_argument("--system-predict-txts", nargs="+", required=True,
+                        help="system prediction files, glob patterns or directories (searched for predict_results_*.txt)")
+    parser.add_argument("--input-file", type=str, default=None, required=True, help="input file")
+    parser.add_argument("--input-file-type", choices=["json", "csv"], default="json")
+    parser.add_argument("--task-type", choices=["single-sentence", "sentence-pair", "swag"], default="single-sentence")
+    parser.add_argument("--classification-type", choices=["classification", "regression"], default="classification")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--bootstrap-samples", type=int, default=1000, help="number of bootstrap samples")
+    parser.add_argument("--bootstrap-chunk-size", type=int, default=100, help="number of bootstrap samples computed at once")
+    parser.add_argument("--confidence", type=float, default=0.95, help="confidence level of the intervals")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for bootstrap sampling")
+    parser.add_argument("--output-file", type=str, default=None, help="output leaderboard tsv (default: stdout)")
+    parser.add_argument("--pairwise-file", type=str, default=None,
+                        help="output tsv of the paired bootstrap tests between all the pairs of runs")
+    args = parser.parse_args()
+
+    main(args)
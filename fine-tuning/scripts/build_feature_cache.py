@@ -0,0 +1,353 @@
+import sys
+import io
+import os
+import argparse
+import json
+import hashlib
+import shutil
+
+import numpy as np
+
+
+# sentence keys of the --metric_name options of the patched run_glue.py
+METRIC_NAME_TO_KEYS = {"sst2": ("sentence", None),
+                       "stsb": ("sentence1", "sentence2"),
+                       "wnli": ("sentence1", "sentence2")}
+
+SPLITS = ["train", "validation", "test"]
+
+# the features of squad_convert_examples_to_features kept as json lines for the postprocessing of the predictions
+SQUAD_METADATA_KEYS = ["example_index", "unique_id", "paragraph_len", "token_is_max_context", "tokens",
+                       "token_to_orig_map", "qas_id"]
+
+
+def get_file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_config(args):
+    config = {"task_type": args.task_type,
+              "model_name_or_path": args.model_name_or_path,
+              "use_fast_tokenizer": args.use_fast_tokenizer,
+              "do_lower_case": args.do_lower_case,
+              "max_seq_length": args.max_seq_length}
+    if args.task_type == "glue":
+        config["metric_name"] = args.metric_name
+    elif args.task_type == "squad":
+        config["doc_stride"] = args.doc_stride
+        config["max_query_length"] = args.max_query_length
+    return config
+
+
+# the directory name of the input files by default (e.g. jsts-v1.3)
+def get_dataset_name(args):
+    if args.dataset_name is not None:
+        return args.dataset_name
+    input_file = next(input_file for input_file in [args.train_file, args.validation_file, args.test_file]
+                      if input_file is not None)
+    return os.path.basename(os.path.dirname(os.path.abspath(input_file)))
+
+
+# one directory per dataset, (tokenizer, max_seq_length, doc_stride) and split
+def get_cache_dir(args, split):
+    config = get_config(args)
+    config_hash = hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:10]
+    name = "{}_{}_{}_{}".format(os.path.basename(args.model_name_or_path.rstrip("/")), args.max_seq_length,
+                                args.doc_stride if args.task_type == "squad" else 0, config_hash)
+    return os.path.join(args.cache_dir, get_dataset_name(args), name, split)
+
+
+def read_json_lines(input_file):
+    with open(input_file, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+# as in run_glue.py: sorted labels of the train set, or none for regression
+def get_label_list(train_file, metric_name):
+    if metric_name == "stsb":
+        return None
+    return sorted({example["label"] for example in read_json_lines(train_file)})
+
+
+def encode_glue(input_file, tokenizer, args, label_list):
+    sentence1_key, sentence2_key = METRIC_NAME_TO_KEYS[args.metric_name]
+    examples = read_json_lines(input_file)
+    label_to_id = {label: i for i, label in enumerate(label_list)} if label_list is not None else None
+    # e.g. the MARC-ja test set has no label
+    has_label = all("label" in example for example in examples)
+
+    arrays = {}
+    for start in range(0, len(examples), args.batch_size):
+        batch = examples[start:start + args.batch_size]
+        texts = ([example[sentence1_key] for example in batch],)
+        if sentence2_key is not None:
+            texts += ([example[sentence2_key] for example in batch],)
+        encoded = tokenizer(*texts, padding="max_length", max_length=args.max_seq_length, truncation=True)
+
+        if len(arrays) == 0:
+            arrays = {key: np.zeros((len(examples), args.max_seq_length), dtype=np.int32) for key in encoded}
+            if has_label is True:
+                arrays["label"] = np.zeros(len(examples), dtype=np.int32 if label_to_id is not None else np.float32)
+        for key, values in encoded.items():
+            arrays[key][start:start + len(batch)] = values
+        if has_label is True:
+            arrays["label"][start:start + len(batch)] = [label_to_id[example["label"]] if label_to_id is not None
+                                                          else example["label"] for example in batch]
+    return arrays, None
+
+
+# as in the patched run_swag.py, but padded to max_seq_length
+def encode_swag(input_file, tokenizer, args):
+    choice_names = [f"choice{i}" for i in range(5)]
+    examples = read_json_lines(input_file)
+    has_label = all("label" in example for example in examples)
+
+    arrays = {}
+    for start in range(0, len(examples), args.batch_size):
+        batch = examples[start:start + args.batch_size]
+        first_sentences = [example["question"] for example in batch for _ in choice_names]
+        second_sentences = [example[choice_name] for example in batch for choice_name in choice_names]
+        encoded = tokenizer(first_sentences, second_sentences, padding="max_length", max_length=args.max_seq_length,
+                            truncation=True)
+
+        if len(arrays) == 0:
+            arrays = {key: np.zeros((len(examples), len(choice_names), args.max_seq_length), dtype=np.int32)
+                      for key in encoded}
+            if has_label is True:
+                arrays["label"] = np.zeros(len(examples), dtype=np.int32)
+        for key, values in encoded.items():
+            arrays[key][start:start + len(batch)] = np.asarray(values, dtype=np.int32).reshape(
+                len(batch), len(choice_names), args.max_seq_length)
+        if has_label is True:
+            arrays["label"][start:start + len(batch)] = [int(example["label"]) for example in batch]
+    return arrays, None
+
+
+# as load_and_cache_examples of run_squad.py (with the patched squad.py)
+def encode_squad(input_file, tokenizer, args, is_training):
+    from transformers.data.processors.squad import SquadV1Processor, squad_convert_examples_to_features
+
+    processor = SquadV1Processor()
+    if is_training is True:
+        examples = processor.get_train_examples(None, filename=input_file)
+    else:
+        examples = processor.get_dev_examples(None, filename=input_file)
+    features = squad_convert_examples_to_features(examples=examples,
+                                                  tokenizer=tokenizer,
+                                                  max_seq_length=args.max_seq_length,
+                                                  doc_stride=args.doc_stride,
+                                                  max_query_length=args.max_query_length,
+                                                  is_training=is_training,
+                                                  threads=args.threads)
+
+    arrays = {"input_ids": np.array([feature.input_ids for feature in features], dtype=np.int32),
+              "attention_mask": np.array([feature.attention_mask for feature in features], dtype=np.int32),
+              "token_type_ids": np.array([feature.token_type_ids for feature in features], dtype=np.int32),
+              "cls_index": np.array([feature.cls_index for feature in features], dtype=np.int32),
+              "p_mask": np.array([feature.p_mask for feature in features], dtype=np.int32),
+              "is_impossible": np.array([feature.is_impossible for feature in features], dtype=np.int32),
+              "start_positions": np.array([feature.start_position for feature in features], dtype=np.int32),
+              "end_positions": np.array([feature.end_position for feature in features], dtype=np.int32)}
+    metadata = [{key: getattr(feature, key) for key in SQUAD_METADATA_KEYS} for feature in features]
+    return arrays, metadata
+
+
+def write_feature_cache(cache_dir, arrays, index, metadata=None):
+    # written to a temporary directory first, so that a cache directory is always complete
+    tmp_dir = cache_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    index["num"] = len(next(iter(arrays.values()))) if len(arrays) > 0 else 0
+    index["columns"] = {}
+    for key, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{key}.npy"), array)
+        index["columns"][key] = {"dtype": str(array.dtype), "shape": list(array.shape)}
+
+    if metadata is not None:
+        with open(os.path.join(tmp_dir, "metadata.jsonl"), "w", encoding="utf-8") as f:
+            for feature_metadata in metadata:
+                f.write(json.dumps(feature_metadata, ensure_ascii=False) + "\n")
+
+    with open(os.path.join(tmp_dir, "index.json"), "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(tmp_dir, cache_dir)
+
+
+def is_up_to_date(cache_dir, index):
+    index_file = os.path.join(cache_dir, "index.json")
+    if not os.path.exists(index_file):
+        return False
+    with open(index_file, "r", encoding="utf-8") as f:
+        cached_index = json.load(f)
+    return all(cached_index.get(key) == value for key, value in index.items())
+
+
+# memory-mapped features of a cache directory, usable as a map-style dataset of the training scripts
+# (e.g. in place of the datasets.map(preprocess_function) outputs for Trainer, whose collators take "label")
+class FeatureCacheDataset(object):
+    def __init__(self, cache_dir, columns=None, return_tensors=None):
+        with open(os.path.join(cache_dir, "index.json"), "r", encoding="utf-8") as f:
+            self.index = json.load(f)
+        self._cache_dir = cache_dir
+
+        if columns is None:
+            columns = list(self.index["columns"])
+        # copy-on-write, so that torch.from_numpy can take the rows without copying the files
+        self.arrays = {column: np.load(os.path.join(cache_dir, f"{column}.npy"), mmap_mode="c") for column in columns}
+
+        self._torch = None
+        if return_tensors == "pt":
+            import torch
+            self._torch = torch
+
+    def __len__(self):
+        return self.index["num"]
+
+    def __getitem__(self, idx):
+        if self._torch is not None:
+            return {column: self._torch.from_numpy(np.array(array[idx])) for column, array in self.arrays.items()}
+        return {column: array[idx] for column, array in self.arrays.items()}
+
+    def has_label(self):
+        return self.index.get("has_label", "label" in self.index["columns"])
+
+    def get_label_list(self):
+        return self.index.get("label_list")
+
+    def get_metadata(self):
+        with open(os.path.join(self._cache_dir, "metadata.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+# the TensorDataset of run_squad.py's load_and_cache_examples
+def get_squad_tensor_dataset(feature_cache_dataset, evaluate=False):
+    import torch
+    from torch.utils.data import TensorDataset
+
+    def get_tensor(column):
+        return torch.from_numpy(feature_cache_dataset.arrays[column]).long()
+
+    if evaluate is True:
+        return TensorDataset(get_tensor("input_ids"), get_tensor("attention_mask"), get_tensor("token_type_ids"),
+                             torch.arange(len(feature_cache_dataset), dtype=torch.long),
+                             get_tensor("cls_index"), get_tensor("p_mask").float())
+    return TensorDataset(get_tensor("input_ids"), get_tensor("attention_mask"), get_tensor("token_type_ids"),
+                         get_tensor("start_positions"), get_tensor("end_positions"), get_tensor("cls_index"),
+                         get_tensor("p_mask").float(), get_tensor("is_impossible").float())
+
+
+# the SquadFeatures of run_squad.py's evaluate, for compute_predictions_logits
+def load_squad_features(feature_cache_dataset):
+    from transformers.data.processors.squad import SquadFeatures
+
+    features = []
+    for idx, feature_metadata in enumerate(feature_cache_dataset.get_metadata()):
+        row = feature_cache_dataset[idx]
+        # json turns the int keys of token_to_orig_map and token_is_max_context into strings
+        features.append(SquadFeatures(input_ids=row["input_ids"].tolist(),
+                                      attention_mask=row["attention_mask"].tolist(),
+                                      token_type_ids=row["token_type_ids"].tolist(),
+                                      cls_index=int(row["cls_index"]),
+                                      p_mask=row["p_mask"].tolist(),
+                                      example_index=feature_metadata["example_index"],
+                                      unique_id=feature_metadata["unique_id"],
+                                      paragraph_len=feature_metadata["paragraph_len"],
+                                      token_is_max_context={int(k): v for k, v in
+                                                            feature_metadata["token_is_max_context"].items()},
+                                      tokens=feature_metadata["tokens"],
+                                      token_to_orig_map={int(k): v for k, v in
+                                                         feature_metadata["token_to_orig_map"].items()},
+                                      start_position=int(row["start_positions"]),
+                                      end_position=int(row["end_positions"]),
+                                      is_impossible=bool(row["is_impossible"]),
+                                      qas_id=feature_metadata["qas_id"]))
+    return features
+
+
+def get_tokenizer(args):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, use_fast=args.use_fast_tokenizer,
+                                              do_lower_case=args.do_lower_case)
+    # as run_glue.py and run_swag.py
+    if args.max_seq_length > tokenizer.model_max_length:
+        print(f"max_seq_length {args.max_seq_length} is larger than the model max length "
+              f"{tokenizer.model_max_length}: using {tokenizer.model_max_length}", file=sys.stderr)
+        args.max_seq_length = tokenizer.model_max_length
+    return tokenizer
+
+
+def main(args):
+    input_files = dict(zip(SPLITS, [args.train_file, args.validation_file, args.test_file]))
+    # loaded first, since max_seq_length may be limited by the model and it is a part of the cache key
+    tokenizer = get_tokenizer(args)
+
+    label_list = None
+    if args.task_type == "glue":
+        assert args.train_file is not None, "--train-file is needed for the label list"
+        label_list = get_label_list(args.train_file, args.metric_name)
+
+    for split, input_file in input_files.items():
+        if input_file is None:
+            continue
+
+        index = dict(get_config(args), split=split, input_file_hash=get_file_hash(input_file), label_list=label_list)
+        cache_dir = get_cache_dir(args, split)
+        if args.force is False and is_up_to_date(cache_dir, index):
+            print(f"{split}: up to date: {cache_dir}", file=sys.stderr)
+            continue
+
+        if args.task_type == "glue":
+            arrays, metadata = encode_glue(input_file, tokenizer, args, label_list)
+        elif args.task_type == "swag":
+            arrays, metadata = encode_swag(input_file, tokenizer, args)
+        else:
+            arrays, metadata = encode_squad(input_file, tokenizer, args, is_training=split == "train")
+        if args.task_type != "squad":
+            # whether the examples of the split have labels ("label" column)
+            index["has_label"] = "label" in arrays
+
+        write_feature_cache(cache_dir, arrays, index, metadata=metadata)
+        print(f"{split}: {index['num']} features: {cache_dir}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.stdin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+
+    parser = argparse.ArgumentParser(description="build memory-mapped features for the fine-tuning scripts")
+    parser.add_argument("--task-type", choices=["glue", "swag", "squad"], required=True,
+                        help="glue: run_glue.py (MARC-ja, JSTS, JNLI), swag: run_swag.py (JCommonsenseQA), squad: run_squad.py (JSQuAD)")
+    parser.add_argument("--model-name-or-path", type=str, required=True, help="tokenizer name or path")
+    parser.add_argument("--use-fast-tokenizer", action='store_true', default=False, help="use a fast tokenizer")
+    parser.add_argument("--do-lower-case", action='store_true', default=False, help="lowercase the input")
+    parser.add_argument("--metric-name", choices=list(METRIC_NAME_TO_KEYS), default=None, help="--metric_name of run_glue.py")
+    parser.add_argument("--max-seq-length", type=int, default=128, help="max sequence length")
+    parser.add_argument("--doc-stride", type=int, default=128, help="doc stride (squad)")
+    parser.add_argument("--max-query-length", type=int, default=64, help="max query length (squad)")
+    parser.add_argument("--train-file", type=str, default=None, help="train file")
+    parser.add_argument("--validation-file", type=str, default=None, help="validation file")
+    parser.add_argument("--test-file", type=str, default=None, help="test file")
+    parser.add_argument("--cache-dir", type=str, required=True, help="root directory of the feature caches")
+    parser.add_argument("--dataset-name", type=str, default=None, help="dataset name in the cache dir (default: the directory name of the input files)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="number of examples tokenized at once (glue, swag)")
+    parser.add_argument("--threads", type=int, default=1, help="number of processes for squad_convert_examples_to_features")
+    parser.add_argument("--force", action='store_true', default=False, help="rebuild the caches even if they are up to date")
+    args = parser.parse_args()
+    if args.task_type == "glue":
+        assert args.metric_name is not None, "--metric-name is needed for --task-type glue"
+    assert any(input_file is not None for input_file in [args.train_file, args.validation_file, args.test_file]), \
+        "no input file"
+
+    main(args)
@@ -5,6 +5,8 @@ import argparse
 import json
 import csv
 
+import numpy as np
+
 
 def get_input_string(input_data, task_type, additional_column_name_string):
     input_strings = []
@@ -35,7 +37,7 @@ def get_eval_string(input_data, system_predict,
             return "CORRECT" if system_predict == str(input_data["label"]) else "WRONG"
 
 
-def print_header(args):
+def get_header(args):
     columns = []
     if args.additional_column_name_string is not None:
         columns.extend(args.additional_column_name_string.split(","))
@@ -50,37 +52,103 @@ def print_header(args):
     columns.append("gold")
     columns.append("eval")
 
-    print("\t".join(columns))
+    return "\t".join(columns)
+
+
+def print_header(args):
+    print(get_header(args))
+
+
+def get_ranks(values):
+    # average ranks for ties, as in scipy.stats.rankdata
+    sorter = np.argsort(values, kind="mergesort")
+    sorted_values = values[sorter]
+    is_new = np.concatenate(([True], sorted_values[1:] != sorted_values[:-1]))
+    dense_ranks = np.cumsum(is_new)[np.argsort(sorter, kind="mergesort")]
+    counts = np.concatenate(np.nonzero(is_new) + ([len(values)],))
+    return 0.5 * (counts[dense_ranks] + counts[dense_ranks - 1] + 1)
+
+
+def get_pearson(x, y):
+    if len(x) < 2 or np.std(x) == 0 or np.std(y) == 0:
+        return float("nan")
+    return float(np.corrcoef(x, y)[0, 1])
+
+
+def compute_metrics(system_predicts, golds, classification_type):
+    metrics = {"num": len(golds)}
+    if classification_type == "regression":
+        system_predicts = np.asarray(system_predicts, dtype=np.float64)
+        golds = np.asarray(golds, dtype=np.float64)
+        metrics["pearson"] = get_pearson(system_predicts, golds)
+        metrics["spearman"] = get_pearson(get_ranks(system_predicts), get_ranks(golds))
+        metrics["mean_absolute_error"] = float(np.mean(np.abs(system_predicts - golds))) if len(golds) > 0 else float("nan")
+    elif classification_type == "classification":
+        metrics["accuracy"] = float(np.mean(np.asarray(system_predicts) == np.asarray(golds))) if len(golds) > 0 else float("nan")
+    return metrics
+
+
+# a system prediction and a gold label as comparable keys for compute_metrics
+def get_metric_keys(input_data, system_predict, classification_type, task_type):
+    if classification_type == "regression":
+        return float(system_predict), float(input_data["label"])
+    elif task_type == "swag":
+        return int(system_predict), input_data["label"]
+    else:
+        return system_predict, str(input_data["label"])
+
+
+def iter_rows(system_f, input_f, input_file_type):
+    next(system_f)
+
+    # both files are read lazily, line by line
+    for row_system_predict, input in zip(csv.reader(system_f, delimiter="\t"),
+                                         input_f if input_file_type == "json"
+                                         else csv.DictReader(input_f)):
+        input_data = None
+        if input_file_type == "json":
+            input_data = json.loads(input)
+        else:
+            input_data = input
+
+        yield input_data, row_system_predict[1]
 
 
 def main(args):
-    print_header(args)
+    writer = sys.stdout
+    if args.metrics_only is False:
+        writer.write(get_header(args) + "\n")
 
-    with open(args.system_predict_txt, "r", encoding="utf-8") as system_f:
-        next(system_f)
+    # predictions and gold labels are collected as comparable keys for the vectorized metrics
+    system_predicts, golds = [], []
 
+    with open(args.system_predict_txt, "r", encoding="utf-8") as system_f:
         with open(args.input_file, "r", encoding="utf-8") as input_f:
-            for row_system_predict, input in zip(csv.reader(system_f, delimiter="\t"),
-                                                 input_f.readlines() if args.input_file_type == "json"
-                                                 else csv.DictReader(input_f)):
-                input_data = None
-                if args.input_file_type == "json":
-                    input_data = json.loads(input)
-                else:
-                    input_data = input
+            for input_data, system_predict in iter_rows(system_f, input_f, args.input_file_type):
+                system_key, gold_key = get_metric_keys(input_data, system_predict,
+                                                       args.classification_type, args.task_type)
+                system_predicts.append(system_key)
+                golds.append(gold_key)
 
-                system_predict = row_system_predict[1]
+                if args.metrics_only is True:
+                    continue
 
                 input_string = get_input_string(input_data, args.task_type,
                                                 args.additional_column_name_string)
                 eval_string = get_eval_string(input_data, system_predict,
                                               args.classification_type, args.task_type)
                 # input  system  gold  evaluation
-                print("{}\t{}\t{}\t{}".format(input_string,
-                                              system_predict,
-                                              input_data["label"],
-                                              eval_string
-                                              ))
+                writer.write("{}\t{}\t{}\t{}\n".format(input_string,
+                                                       system_predict,
+                                                       input_data["label"],
+                                                       eval_string
+                                                       ))
+
+    metrics = compute_metrics(system_predicts, golds, args.classification_type)
+    print(json.dumps(metrics), file=sys.stderr)
+    if args.metrics_file is not None:
+        with open(args.metrics_file, "w") as f:
+            json.dump(metrics, f, indent=4)
 
 
 if __name__ == "__main__":
@@ -95,6 +163,8 @@ if __name__ == "__main__":
     parser.add_argument("--task-type", choices=["single-sentence", "sentence-pair", "swag"], default="single-sentence")
     parser.add_argument("--classification-type", choices=["classification", "regression"], default="classification")
     parser.add_argument("--additional-column-name-string", type=str, default=None, help="additional column name string (comma separated)")
+    parser.add_argument("--metrics-file", type=str, default=None, help="output json file for metrics (accuracy, or pearson/spearman for regression)")
+    parser.add_argument("--metrics-only", action='store_true', default=False, help="only compute metrics without per-row results")
     args = parser.parse_args()
 
     main(args)
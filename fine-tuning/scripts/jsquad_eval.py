@@ -0,0 +1,155 @@
+import sys
+import io
+import argparse
+import glob
+import json
+from collections import Counter
+
+
+# the same normalization as squad_metrics.normalize_answer in the JGLUE patch:
+# lowercasing, no punctuation removal, stripping trailing "。" and whitespace normalization
+def normalize_answer(s):
+    return " ".join(s.lower().rstrip("。").split())
+
+
+class GoldQuestion(object):
+    # normalized gold answers and their character histograms are computed once per question
+    def __init__(self, answer_texts):
+        gold_answers = [answer_text for answer_text in answer_texts if normalize_answer(answer_text)]
+        if not gold_answers:
+            # For unanswerable questions, only correct answer is empty string
+            gold_answers = [""]
+        self.normalized_answers = [normalize_answer(gold_answer) for gold_answer in gold_answers]
+        self.answer_counters = [Counter(normalized_answer) for normalized_answer in self.normalized_answers]
+
+    def score(self, prediction):
+        normalized_prediction = normalize_answer(prediction)
+        prediction_counter = Counter(normalized_prediction)
+
+        exact, f1 = 0, 0.0
+        for normalized_answer, answer_counter in zip(self.normalized_answers, self.answer_counters):
+            exact = max(exact, int(normalized_answer == normalized_prediction))
+            f1 = max(f1, compute_f1(answer_counter, len(normalized_answer),
+                                    prediction_counter, len(normalized_prediction)))
+        return exact, f1
+
+
+# character-based F1 as in squad_metrics.compute_f1 in the JGLUE patch
+def compute_f1(gold_counter, gold_length, prediction_counter, prediction_length):
+    if gold_length == 0 or prediction_length == 0:
+        # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+        return int(gold_length == prediction_length)
+    num_same = sum((gold_counter & prediction_counter).values())
+    if num_same == 0:
+        return 0
+    precision = 1.0 * num_same / prediction_length
+    recall = 1.0 * num_same / gold_length
+    return (2 * precision * recall) / (precision + recall)
+
+
+def load_squad_data(input_file):
+    with open(input_file, "r", encoding="utf-8") as f:
+        return json.load(f)["data"]
+
+
+class JSQuADScorer(object):
+    # data: the articles of a SQuAD-format json
+    def __init__(self, data):
+        self.gold_questions = {}
+        self.has_answer = {}
+        for article in data:
+            for paragraph in article["paragraphs"]:
+                for qa in paragraph["qas"]:
+                    self.gold_questions[qa["id"]] = GoldQuestion([answer["text"] for answer in qa["answers"]])
+                    self.has_answer[qa["id"]] = bool(qa["answers"])
+
+        # scores are shared across prediction files, so the same prediction is scored only once
+        self._score_cache = {}
+
+    def score(self, qas_id, prediction):
+        key = (qas_id, normalize_answer(prediction))
+        if key not in self._score_cache:
+            self._score_cache[key] = self.gold_questions[qas_id].score(prediction)
+        return self._score_cache[key]
+
+    def evaluate(self, predictions):
+        exact_scores, f1_scores = {}, {}
+        for qas_id in self.gold_questions:
+            if qas_id not in predictions:
+                print(f"Missing prediction for {qas_id}", file=sys.stderr)
+                continue
+            exact_scores[qas_id], f1_scores[qas_id] = self.score(qas_id, predictions[qas_id])
+
+        evaluation = make_eval_dict(exact_scores, f1_scores)
+        has_ans_qids = [qas_id for qas_id in exact_scores if self.has_answer[qas_id]]
+        no_ans_qids = [qas_id for qas_id in exact_scores if not self.has_answer[qas_id]]
+        if has_ans_qids:
+            evaluation.update(make_eval_dict(exact_scores, f1_scores, qid_list=has_ans_qids, prefix="HasAns_"))
+        if no_ans_qids:
+            evaluation.update(make_eval_dict(exact_scores, f1_scores, qid_list=no_ans_qids, prefix="NoAns_"))
+        return evaluation
+
+    # oracle scores of the top-k candidates of n-best lists
+    def evaluate_nbest(self, nbest_predictions, ks):
+        evaluation = {}
+        for k in ks:
+            exact_scores, f1_scores = {}, {}
+            for qas_id in self.gold_questions:
+                if qas_id not in nbest_predictions:
+                    continue
+                scores = [self.score(qas_id, candidate["text"]) for candidate in nbest_predictions[qas_id][:k]]
+                exact_scores[qas_id] = max((exact for exact, _ in scores), default=0)
+                f1_scores[qas_id] = max((f1 for _, f1 in scores), default=0.0)
+            evaluation.update(make_eval_dict(exact_scores, f1_scores, prefix=f"top{k}_"))
+        return evaluation
+
+
+def make_eval_dict(exact_scores, f1_scores, qid_list=None, prefix=""):
+    if qid_list is None:
+        qid_list = list(exact_scores.keys())
+    total = len(qid_list)
+    if total == 0:
+        return {f"{prefix}exact": 0.0, f"{prefix}f1": 0.0, f"{prefix}total": 0}
+    return {f"{prefix}exact": 100.0 * sum(exact_scores[k] for k in qid_list) / total,
+            f"{prefix}f1": 100.0 * sum(f1_scores[k] for k in qid_list) / total,
+            f"{prefix}total": total}
+
+
+def get_files(patterns):
+    files = []
+    for pattern in patterns:
+        files.extend(sorted(glob.glob(pattern)))
+    return list(dict.fromkeys(files))
+
+
+def main(args):
+    scorer = JSQuADScorer(load_squad_data(args.input_file))
+
+    for prediction_file in get_files(args.prediction_files):
+        with open(prediction_file, "r", encoding="utf-8") as f:
+            predictions = json.load(f)
+        evaluation = scorer.evaluate(predictions)
+        print(json.dumps(dict(file=prediction_file, **evaluation), ensure_ascii=False))
+
+    for nbest_file in get_files(args.nbest_files):
+        with open(nbest_file, "r", encoding="utf-8") as f:
+            nbest_predictions = json.load(f)
+        evaluation = scorer.evaluate_nbest(nbest_predictions, args.nbest_ks)
+        print(json.dumps(dict(file=nbest_file, **evaluation), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    sys.stdin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+
+    parser = argparse.ArgumentParser(description="evaluate JSQuAD predictions (EM/F1)")
+    parser.add_argument("--input-file", type=str, required=True, help="JSQuAD gold file")
+    parser.add_argument("--prediction-files", nargs="*", default=[],
+                        help="predictions_*.json files or glob patterns ({qas_id: text})")
+    parser.add_argument("--nbest-files", nargs="*", default=[],
+                        help="nbest_predictions_*.json files or glob patterns ({qas_id: [{text: ...}, ...]})")
+    parser.add_argument("--nbest-ks", nargs="*", type=int, default=[1, 5, 20], help="k for the top-k oracle scores of n-best lists")
+    args = parser.parse_args()
+
+    main(args)
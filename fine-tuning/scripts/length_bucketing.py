@@ -0,0 +1,161 @@
+import sys
+import io
+import argparse
+import json
+
+import numpy as np
+
+
+MODEL_INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+
+# number of tokens of each example (the longest choice for multiple choice), from the attention masks
+def get_lengths(dataset):
+    if hasattr(dataset, "arrays"):
+        # FeatureCacheDataset of build_feature_cache.py
+        attention_mask = dataset.arrays["attention_mask"]
+        lengths = np.asarray(attention_mask).sum(axis=-1)
+    else:
+        # e.g. datasets.Dataset processed by preprocess_function of run_glue.py/run_swag.py
+        lengths = np.array([np.asarray(attention_mask).sum(axis=-1) for attention_mask in dataset["attention_mask"]])
+    if lengths.ndim > 1:
+        lengths = lengths.max(axis=-1)
+    return lengths.astype(np.int64)
+
+
+# number of sequences per example: the number of choices for multiple choice (run_swag.py), otherwise 1
+def get_sequence_num(dataset):
+    if hasattr(dataset, "arrays"):
+        shape = dataset.arrays["attention_mask"].shape[1:]
+    elif len(dataset) > 0:
+        shape = np.asarray(dataset[0]["attention_mask"]).shape
+    else:
+        return 1
+    return int(shape[0]) if len(shape) > 1 else 1
+
+
+# indices of the examples sorted by length, cut into batches of at most max_tokens tokens
+# (batch size × sequence_num × the longest example in the batch) and max_batch_size examples
+def get_token_budget_batches(lengths, max_tokens, max_batch_size=None, sequence_num=1):
+    batches = []
+    batch, batch_max_length = [], 0
+    for idx in np.argsort(lengths, kind="mergesort"):
+        length = max(int(lengths[idx]), 1)
+        new_max_length = max(batch_max_length, length)
+        if len(batch) > 0 and ((len(batch) + 1) * sequence_num * new_max_length > max_tokens or
+                               (max_batch_size is not None and len(batch) == max_batch_size)):
+            batches.append(batch)
+            batch, new_max_length = [], length
+        batch.append(int(idx))
+        batch_max_length = new_max_length
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+# can be given to torch.utils.data.DataLoader as batch_sampler
+class TokenBudgetBatchSampler(object):
+    def __init__(self, lengths, max_tokens, max_batch_size=None, sequence_num=1):
+        self.batches = get_token_budget_batches(lengths, max_tokens, max_batch_size=max_batch_size,
+                                                sequence_num=sequence_num)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def get_padding_ratio(lengths, batches):
+    real_token_num = sum(int(lengths[idx]) for batch in batches for idx in batch)
+    padded_token_num = sum(len(batch) * int(max(lengths[idx] for idx in batch)) for batch in batches)
+    return 1.0 - real_token_num / padded_token_num if padded_token_num > 0 else 0.0
+
+
+# padding ratios of fixed-size batches padded to max_seq_length (as the fine-tuning scripts do) and of the token budget batches
+def get_padding_report(lengths, batches, max_seq_length, batch_size):
+    fixed_batches = [list(range(start, min(start + batch_size, len(lengths))))
+                     for start in range(0, len(lengths), batch_size)]
+    return {"num": len(lengths),
+            "fixed_batch_num": len(fixed_batches),
+            "fixed_padding_ratio": 1.0 - float(np.sum(lengths)) / (len(lengths) * max_seq_length) if len(lengths) > 0 else 0.0,
+            "dynamic_padding_ratio": get_padding_ratio(lengths, fixed_batches),
+            "bucketed_batch_num": len(batches),
+            "bucketed_padding_ratio": get_padding_ratio(lengths, batches)}
+
+
+# stacks the model inputs of the examples and trims the padding beyond the longest example of the batch
+def collate_trimmed(examples, input_names=MODEL_INPUT_NAMES):
+    import torch
+
+    length = max(int(np.asarray(example["attention_mask"]).sum(axis=-1).max()) for example in examples)
+    batch = {}
+    for input_name in input_names:
+        if input_name not in examples[0]:
+            continue
+        values = np.stack([np.asarray(example[input_name]) for example in examples])
+        batch[input_name] = torch.from_numpy(values[..., :length].astype(np.int64))
+    return batch
+
+
+# puts the outputs of the batches back in the original order of the examples
+def restore_order(batches, batch_outputs):
+    num = sum(len(batch) for batch in batches)
+    outputs = None
+    for batch, batch_output in zip(batches, batch_outputs):
+        if outputs is None:
+            outputs = np.zeros((num,) + batch_output.shape[1:], dtype=batch_output.dtype)
+        outputs[batch] = batch_output
+    return outputs
+
+
+# the logits of trainer.predict(dataset).predictions, computed with token budget batches
+# with report_batch_size, the padding ratios are compared with the fixed-size batches of this size and printed to stderr
+def predict_with_length_buckets(model, dataset, max_tokens, max_batch_size=None, device=None, report_batch_size=None):
+    import torch
+
+    lengths = get_lengths(dataset)
+    batches = get_token_budget_batches(lengths, max_tokens, max_batch_size=max_batch_size,
+                                       sequence_num=get_sequence_num(dataset))
+    if report_batch_size is not None and len(lengths) > 0:
+        max_seq_length = np.asarray(dataset[0]["input_ids"]).shape[-1]
+        print(json.dumps(get_padding_report(lengths, batches, max_seq_length, report_batch_size)), file=sys.stderr)
+
+    if device is None:
+        device = next(model.parameters()).device
+    model.eval()
+
+    batch_outputs = []
+    with torch.no_grad():
+        for batch in batches:
+            inputs = {key: value.to(device) for key, value in collate_trimmed([dataset[idx] for idx in batch]).items()}
+            logits = model(**inputs).logits
+            batch_outputs.append(logits.float().cpu().numpy())
+    return restore_order(batches, batch_outputs)
+
+
+def main(args):
+    from build_feature_cache import FeatureCacheDataset
+
+    dataset = FeatureCacheDataset(args.feature_cache_dir, columns=["attention_mask"])
+    lengths = get_lengths(dataset)
+    batches = get_token_budget_batches(lengths, args.max_tokens, max_batch_size=args.max_batch_size,
+                                       sequence_num=get_sequence_num(dataset))
+    max_seq_length = dataset.index["max_seq_length"]
+    report = get_padding_report(lengths, batches, max_seq_length, args.batch_size)
+    print(json.dumps(dict(max_seq_length=max_seq_length, max_tokens=args.max_tokens, **report), indent=4))
+
+
+if __name__ == "__main__":
+    sys.stdin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+
+    parser = argparse.ArgumentParser(description="report the padding ratios of token budget batches")
+    parser.add_argument("--feature-cache-dir", type=str, required=True, help="a split directory made by build_feature_cache.py")
+    parser.add_argument("--max-tokens", type=int, default=8192, help="max number of tokens (including padding) per batch")
+    parser.add_argument("--max-batch-size", type=int, default=None, help="max number of examples per batch")
+    parser.add_argument("--batch-size", type=int, default=32, help="batch size of the fixed-size batches to compare with")
+    args = parser.parse_args()
+
+    main(args)
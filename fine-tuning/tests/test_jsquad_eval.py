@@ -0,0 +1,120 @@
+import os
+import sys
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from jsquad_eval import JSQuADScorer
+
+
+# a copy of squad_metrics.py of transformers 4.9.2 with patch/transformers-4.9.2_jglue-1.3.0.patch applied
+def patched_normalize_answer(s):
+    """Lower text and remove punctuation, articles and extra whitespace."""
+
+    def remove_articles(text):
+        return text.rstrip("。")
+
+    def white_space_fix(text):
+        return " ".join(text.split())
+
+    def remove_punc(text):
+        # do nothing
+        return text
+
+    def lower(text):
+        return text.lower()
+
+    return white_space_fix(remove_articles(remove_punc(lower(s))))
+
+
+def patched_compute_exact(a_gold, a_pred):
+    return int(patched_normalize_answer(a_gold) == patched_normalize_answer(a_pred))
+
+
+def patched_compute_f1(a_gold, a_pred):
+    # character-base
+    gold_toks = list(patched_normalize_answer(a_gold))
+    pred_toks = list(patched_normalize_answer(a_pred))
+
+    common = collections.Counter(gold_toks) & collections.Counter(pred_toks)
+    num_same = sum(common.values())
+    if len(gold_toks) == 0 or len(pred_toks) == 0:
+        # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+        return int(gold_toks == pred_toks)
+    if num_same == 0:
+        return 0
+    precision = 1.0 * num_same / len(pred_toks)
+    recall = 1.0 * num_same / len(gold_toks)
+    f1 = (2 * precision * recall) / (precision + recall)
+    return f1
+
+
+# get_raw_scores of squad_metrics.py
+def patched_get_raw_scores(data, preds):
+    exact_scores, f1_scores = {}, {}
+    for article in data:
+        for p in article["paragraphs"]:
+            for qa in p["qas"]:
+                qid = qa["id"]
+                gold_answers = [a["text"] for a in qa["answers"] if patched_normalize_answer(a["text"])]
+                if not gold_answers:
+                    # For unanswerable questions, only correct answer is empty string
+                    gold_answers = [""]
+                if qid not in preds:
+                    continue
+                prediction = preds[qid]
+                exact_scores[qid] = max(patched_compute_exact(a, prediction) for a in gold_answers)
+                f1_scores[qid] = max(patched_compute_f1(a, prediction) for a in gold_answers)
+    return exact_scores, f1_scores
+
+
+def get_article(qas):
+    return {"title": "東京",
+            "paragraphs": [{"context": "東京 [SEP] 東京は日本の首都である。",
+                            "qas": [{"id": qas_id, "question": "日本の首都は?",
+                                     "answers": [{"text": text, "answer_start": 0} for text in answers]}
+                                    for qas_id, answers in qas]}]}
+
+
+# (qas id, gold answers, predictions)
+CASES = [
+    # exact match, and the trailing "。" and case
+    ("exact", ["東京"], ["東京", "東京。", "東京。。", "とうきょう"]),
+    ("case", ["JR東日本"], ["jr東日本", "JR 東日本", "ＪＲ東日本"]),
+    # whitespace is normalized, but not removed inside the answer
+    ("whitespace", ["東京 都"], ["東京 都", " 東京  都 ", "東京都", "東京\t都\n"]),
+    # punctuation is kept, except the trailing "。"
+    ("punctuation", ["「坊っちゃん」"], ["坊っちゃん", "「坊っちゃん」", "「坊っちゃん」。", "『坊っちゃん』", "坊っちゃん。"]),
+    ("inner_period", ["1。5"], ["1。5", "1。5。", "1.5"]),
+    # the best of multiple gold answers
+    ("multiple", ["徳川家康", "家康", "江戸幕府の初代将軍"], ["家康", "徳川", "初代将軍家康", "江戸幕府", ""]),
+    # gold answers that are empty after the normalization are ignored
+    ("empty_gold", ["。", "名古屋"], ["名古屋", "", "。"]),
+    ("no_answer", [], ["", "東京", "。"]),
+    # partial overlap of characters
+    ("partial", ["東京大学"], ["京都大学", "大学東京", "東", "東京大学大学院"]),
+]
+
+
+def test_scores_match_patched_squad_metrics():
+    for case_idx in range(max(len(predictions) for _, _, predictions in CASES)):
+        data = [get_article([(qas_id, answers) for qas_id, answers, _ in CASES])]
+        preds = {qas_id: predictions[case_idx % len(predictions)] for qas_id, _, predictions in CASES}
+
+        expected_exact, expected_f1 = patched_get_raw_scores(data, preds)
+        scorer = JSQuADScorer(data)
+        for qas_id, prediction in preds.items():
+            exact, f1 = scorer.score(qas_id, prediction)
+            assert exact == expected_exact[qas_id], (qas_id, prediction)
+            assert f1 == expected_f1[qas_id], (qas_id, prediction)
+
+
+def test_evaluate_matches_patched_squad_metrics():
+    data = [get_article([(qas_id, answers) for qas_id, answers, _ in CASES])]
+    preds = {qas_id: predictions[-1] for qas_id, _, predictions in CASES}
+    expected_exact, expected_f1 = patched_get_raw_scores(data, preds)
+
+    evaluation = JSQuADScorer(data).evaluate(preds)
+    assert evaluation["total"] == len(CASES)
+    assert evaluation["exact"] == 100.0 * sum(expected_exact.values()) / len(CASES)
+    assert evaluation["f1"] == 100.0 * sum(expected_f1.values()) / len(CASES)
+    assert evaluation["NoAns_total"] == 1
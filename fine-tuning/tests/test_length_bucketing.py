@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from length_bucketing import get_lengths, get_sequence_num, get_token_budget_batches
+
+
+# the arrays of a FeatureCacheDataset of build_feature_cache.py
+class ArrayDataset(object):
+    def __init__(self, attention_mask):
+        self.arrays = {"attention_mask": attention_mask}
+
+    def __len__(self):
+        return len(self.arrays["attention_mask"])
+
+
+def get_attention_mask(lengths, max_seq_length):
+    return (np.arange(max_seq_length) < np.asarray(lengths)[..., None]).astype(np.int32)
+
+
+def get_batch_token_num(batch, lengths, sequence_num):
+    return len(batch) * sequence_num * max(int(lengths[idx]) for idx in batch)
+
+
+def test_single_sequence_budget():
+    rng = np.random.default_rng(1)
+    dataset = ArrayDataset(get_attention_mask(rng.integers(1, 128, size=200), 128))
+    lengths = get_lengths(dataset)
+    assert get_sequence_num(dataset) == 1
+
+    batches = get_token_budget_batches(lengths, 1024, sequence_num=get_sequence_num(dataset))
+    assert sorted(idx for batch in batches for idx in batch) == list(range(200))
+    assert all(get_batch_token_num(batch, lengths, 1) <= 1024 for batch in batches)
+
+
+def test_multiple_choice_budget():
+    rng = np.random.default_rng(1)
+    # 5 choices per example, as JCommonsenseQA in run_swag.py
+    choice_lengths = rng.integers(1, 64, size=(200, 5))
+    dataset = ArrayDataset(get_attention_mask(choice_lengths, 64))
+    lengths = get_lengths(dataset)
+    assert (lengths == choice_lengths.max(axis=-1)).all()
+    assert get_sequence_num(dataset) == 5
+
+    batches = get_token_budget_batches(lengths, 1024, sequence_num=get_sequence_num(dataset))
+    assert sorted(idx for batch in batches for idx in batch) == list(range(200))
+    # the padded tensors of a batch are (batch size, 5, longest choice)
+    assert all(get_batch_token_num(batch, lengths, 5) <= 1024 for batch in batches)
+    assert len(batches) > len(get_token_budget_batches(lengths, 1024))
+
+
+def test_sequence_num_of_records():
+    # e.g. datasets.Dataset processed by preprocess_function of run_glue.py/run_swag.py
+    assert get_sequence_num([{"attention_mask": [1, 1, 0]}]) == 1
+    assert get_sequence_num([{"attention_mask": [[1, 1, 0]] * 5}]) == 5
@@ -0,0 +1,28 @@
+import importlib
+
+
+# name -> submodule; the submodules (and the heavy dependencies of the scripts behind them) are imported on first use
+_ATTRIBUTES = {"clean_reviews": "marc_ja",
+               "split_reviews": "marc_ja",
+               "build_marc_ja": "marc_ja",
+               "get_morphological_analyzer": "morphological_analysis",
+               "tokenize_strings": "morphological_analysis",
+               "tokenize_records": "morphological_analysis",
+               "read_squad_articles": "jsquad",
+               "align_squad_articles": "jsquad",
+               "read_sharded_records": "sharded",
+               "compute_metrics": "scoring",
+               "score_predictions": "scoring",
+               "score_jsquad": "scoring"}
+
+__all__ = list(_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name not in _ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f"{__name__}.{_ATTRIBUTES[name]}"), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
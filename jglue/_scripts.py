@@ -0,0 +1,39 @@
+import os
+import sys
+import importlib.util
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module name -> script path relative to the repository root
+SCRIPTS = {"marc_ja": "preprocess/marc-ja/scripts/marc-ja.py",
+           "morphological_analyzer": "preprocess/morphological-analysis/scripts/morphological_analyzer.py",
+           "apply_morphological_analysis": "preprocess/morphological-analysis/scripts/apply_morphological_analysis.py",
+           "analyzer_server": "preprocess/morphological-analysis/scripts/analyzer_server.py",
+           "squad_json": "preprocess/morphological-analysis/scripts/squad_json.py",
+           "sharded_output": "preprocess/common/scripts/sharded_output.py",
+           "generate_results": "fine-tuning/scripts/generate_results.py",
+           "jsquad_eval": "fine-tuning/scripts/jsquad_eval.py"}
+
+
+# the scripts are loaded on first use, so that their dependencies (bs4, zenhan, MeCab, pyknp, numpy)
+# are not imported by "import jglue"
+def load_script(name):
+    if name in sys.modules:
+        return sys.modules[name]
+
+    path = os.path.join(ROOT_DIR, SCRIPTS[name])
+    # the scripts import their sibling modules
+    script_dir = os.path.dirname(path)
+    if script_dir not in sys.path:
+        sys.path.append(script_dir)
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
@@ -0,0 +1,20 @@
+from collections import Counter
+
+from jglue._scripts import load_script
+
+
+# yields the articles of a SQuAD-format json file object one by one
+def read_squad_articles(f):
+    squad_json = load_script("squad_json")
+    return iter(squad_json.SquadArticleReader(f))
+
+
+# yields the articles with the title, contexts, questions and answers tokenized and the answer_start positions
+# realigned to the tokenized contexts; the articles are updated in place
+# stats (a Counter) counts the answers and the unaligned answers
+def align_squad_articles(articles, morphological_analyzer, stats=None):
+    apply_morphological_analysis = load_script("apply_morphological_analysis")
+    if stats is None:
+        stats = Counter()
+    for article in articles:
+        yield apply_morphological_analysis.process_squad_article(article, morphological_analyzer, stats)
@@ -0,0 +1,78 @@
+import random
+from collections import defaultdict
+
+from jglue._scripts import load_script
+
+
+# rows: rows of amazon_reviews_multilingual_JP_v1_00.tsv (lists of columns, without the header)
+# stats (a Counter) counts the filtered rows by reason
+def clean_reviews(rows, positive_negative=False, max_char_length=None, h2z=False, stats=None):
+    marc_ja = load_script("marc_ja")
+    for row in rows:
+        instance = marc_ja.clean_row(row, positive_negative=positive_negative, max_char_length=max_char_length,
+                                     h2z=h2z, stats=stats)
+        if instance is not None:
+            yield instance
+
+
+def get_review_id_lists(filter_review_id_list, label_conv_review_id_list):
+    # {"valid": review ids, "test": review ids} and {"valid": {review id: label}, "test": {review id: label}}
+    filter_review_id_sets = defaultdict(set)
+    for eval_type, review_ids in (filter_review_id_list or {}).items():
+        filter_review_id_sets[eval_type] = set(review_ids)
+    label_conv_review_id_dicts = defaultdict(dict)
+    for eval_type, review_id_labels in (label_conv_review_id_list or {}).items():
+        label_conv_review_id_dicts[eval_type] = dict(review_id_labels)
+    return filter_review_id_sets, label_conv_review_id_dicts
+
+
+# yields (eval_type, instance) as marc-ja.py writes them into {eval_type}-v{version}.json
+# split_method "shuffle" gives the same split as marc-ja.py, but keeps all the instances in memory,
+# and "hash" gives the same split as marc-ja.py --split-method hash while streaming
+def split_reviews(instances, split_ratio=(0.94, 0.03, 0.03), split_method="shuffle",
+                  filter_review_id_list=None, label_conv_review_id_list=None, output_testset=False, seed=1):
+    marc_ja = load_script("marc_ja")
+    filter_review_id_list, label_conv_review_id_list = get_review_id_lists(filter_review_id_list,
+                                                                           label_conv_review_id_list)
+    eval_types = ["train", "valid", "test"] if output_testset is True else ["train", "valid"]
+
+    if split_method == "hash":
+        pinned_eval_types = marc_ja.get_pinned_eval_types(filter_review_id_list, label_conv_review_id_list)
+        eval_type_instances = ((pinned_eval_types.get(instance["review_id"])
+                                or marc_ja.get_hash_eval_type(instance["review_id"], split_ratio), instance)
+                               for instance in instances)
+    elif split_method == "shuffle":
+        instances = list(instances)
+        # the same permutation as random.seed(seed); random.shuffle(instances), without the global state
+        random.Random(seed).shuffle(instances)
+        get_eval_type = marc_ja.get_split_eval_type_func(len(instances), split_ratio)
+
+        watched_review_ids = marc_ja.get_watched_review_ids(filter_review_id_list, label_conv_review_id_list)
+        split_review_ids = {eval_type: set() for eval_type in eval_types}
+        for idx, instance in enumerate(instances):
+            if instance["review_id"] in watched_review_ids and get_eval_type(idx) in split_review_ids:
+                split_review_ids[get_eval_type(idx)].add(instance["review_id"])
+        marc_ja.check_split_leakage(split_review_ids, filter_review_id_list, label_conv_review_id_list)
+
+        eval_type_instances = ((get_eval_type(idx), instance) for idx, instance in enumerate(instances))
+    else:
+        raise ValueError(f"unknown split method: {split_method}")
+
+    for eval_type, instance in eval_type_instances:
+        if eval_type not in eval_types:
+            continue
+        instance = marc_ja.convert_instance(instance, eval_type, filter_review_id_list, label_conv_review_id_list)
+        if instance is not None:
+            yield eval_type, instance
+
+
+# {eval_type: [instance, ...]}
+def build_marc_ja(rows, positive_negative=False, max_char_length=None, h2z=False, max_instance_num=None, **kwargs):
+    instances = clean_reviews(rows, positive_negative=positive_negative, max_char_length=max_char_length, h2z=h2z)
+    if max_instance_num is not None:
+        instances = (instance for _, instance in zip(range(max_instance_num), instances))
+
+    datasets = defaultdict(list)
+    for eval_type, instance in split_reviews(instances, **kwargs):
+        datasets[eval_type].append(instance)
+    return dict(datasets)
@@ -0,0 +1,45 @@
+import sys
+
+from jglue._scripts import load_script
+
+
+# a MorphologicalAnalyzer, or a client of analyzer_server.py if server_socket is given and the server is running
+# timeout is in seconds per call to juman/jumanpp; a server uses its own --analyzer-timeout
+def get_morphological_analyzer(analyzer="jumanpp", mecab_dic_dir=None, h2z=False, cache_file=None,
+                               cache_lru_size=100000, server_socket=None, timeout=30):
+    apply_morphological_analysis = load_script("apply_morphological_analysis")
+    analyzer_server = load_script("analyzer_server")
+    analyzer_kwargs = dict(analyzer=analyzer,
+                           mecab_dic_dir=mecab_dic_dir,
+                           h2z=h2z,
+                           cache_file=cache_file,
+                           cache_lru_size=cache_lru_size,
+                           timeout=timeout)
+    if server_socket is not None and analyzer_server.is_server_running(server_socket) is False:
+        server_socket = None
+    return apply_morphological_analysis.get_morphological_analyzer(analyzer_kwargs, server_socket)
+
+
+# yields the tokenized strings ("word word ...", or None for a parse error); the strings are sent to the analyzer
+# batch_size at a time
+def tokenize_strings(strings, morphological_analyzer, batch_size=100):
+    apply_morphological_analysis = load_script("apply_morphological_analysis")
+    for batch in apply_morphological_analysis.get_batches(strings, batch_size):
+        yield from morphological_analyzer.get_tokenized_strings(batch)
+
+
+# yields the records (dicts, e.g. the lines of JSTS/JNLI/JCommonsenseQA) with the columns tokenized in place,
+# as apply_morphological_analysis.py does; a column with a parse error is left as it is
+def tokenize_records(records, column_names, morphological_analyzer, batch_size=100):
+    apply_morphological_analysis = load_script("apply_morphological_analysis")
+    for batch in apply_morphological_analysis.get_batches(records, batch_size):
+        strings = [record[column_name] for record in batch for column_name in column_names]
+        tokenized_strings = iter(morphological_analyzer.get_tokenized_strings(strings))
+        for record in batch:
+            for column_name in column_names:
+                tokenized_string = next(tokenized_strings)
+                if tokenized_string is not None:
+                    record[column_name] = tokenized_string
+                else:
+                    print(f"skip: parse error {record}", file=sys.stderr)
+            yield record
@@ -0,0 +1,25 @@
+from jglue._scripts import load_script
+
+
+# predictions/golds: comparable keys (floats for regression, labels for classification)
+def compute_metrics(system_predicts, golds, classification_type):
+    generate_results = load_script("generate_results")
+    return generate_results.compute_metrics(system_predicts, golds, classification_type)
+
+
+# records: the input records with "label", predictions: the system predictions in the same order
+# (as in the lines of the system predict txt), classification_type: "classification" or "regression"
+def score_predictions(records, predictions, classification_type, task_type=None):
+    generate_results = load_script("generate_results")
+    system_predicts, golds = [], []
+    for record, prediction in zip(records, predictions):
+        system_key, gold_key = generate_results.get_metric_keys(record, prediction, classification_type, task_type)
+        system_predicts.append(system_key)
+        golds.append(gold_key)
+    return generate_results.compute_metrics(system_predicts, golds, classification_type)
+
+
+# articles: the articles of the JSQuAD gold file, predictions: {qas_id: text}
+def score_jsquad(articles, predictions):
+    jsquad_eval = load_script("jsquad_eval")
+    return jsquad_eval.JSQuADScorer(list(articles)).evaluate(predictions)
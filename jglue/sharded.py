@@ -0,0 +1,16 @@
+import json
+
+from jglue._scripts import load_script
+
+
+# yields the records of the json lines written with --shard-size by marc-ja.py/apply_morphological_analysis.py
+# path is the output path (e.g. train-v1.3.json) or its index (train-v1.3.json.index.json)
+# shard_indices selects the shards to read, so that they can be split across processes
+def read_sharded_records(path, shard_indices=None):
+    sharded_output = load_script("sharded_output")
+    reader = sharded_output.ShardedReader(path)
+    if shard_indices is None:
+        shard_indices = range(reader.shard_num)
+    for shard_idx in shard_indices:
+        for line in reader.read_shard(shard_idx):
+            yield json.loads(line)
@@ -0,0 +1,225 @@
+import os
+import io
+import sys
+import argparse
+import json
+import mmap
+import struct
+from array import array
+
+MAGIC = b"JGLUECOL"
+ALIGNMENT = 8
+
+# column types and their array typecodes
+NUMERIC_TYPECODES = {"int": "q", "float": "d"}
+
+
+def get_column_type(values):
+    if all(type(value) is int for value in values):
+        return "int"
+    elif all(type(value) is float for value in values):
+        return "float"
+    elif all(type(value) is str for value in values):
+        return "str"
+    else:
+        return "json"
+
+
+def read_rows(input_file, input_file_type):
+    with open(input_file, "r", encoding="utf-8") as f:
+        if input_file_type == "json":
+            return [json.loads(line) for line in f]
+        elif input_file_type == "squad_json":
+            return json.load(f)["data"]
+
+
+def dump_rows(rows, input_file_type, f):
+    if input_file_type == "json":
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    elif input_file_type == "squad_json":
+        f.write(json.dumps({"data": list(rows)}, ensure_ascii=False) + "\n")
+
+
+def get_blobs(column_type, values):
+    if column_type in NUMERIC_TYPECODES:
+        return [array(NUMERIC_TYPECODES[column_type], values).tobytes()]
+
+    # strings are stored as utf-8 bytes and N + 1 offsets
+    offsets = array("Q", [0])
+    data = bytearray()
+    for value in values:
+        data += (value if column_type == "str" else json.dumps(value, ensure_ascii=False)).encode("utf-8")
+        offsets.append(len(data))
+    return [offsets.tobytes(), bytes(data)]
+
+
+def write_columnar_file(rows, input_file_type, output_file):
+    column_names = list(rows[0].keys()) if len(rows) > 0 else []
+    for idx, row in enumerate(rows):
+        if list(row.keys()) != column_names:
+            raise ValueError(f"row {idx} has columns {list(row.keys())}, but {column_names} are expected")
+
+    columns, blobs = [], []
+    for column_name in column_names:
+        values = [row[column_name] for row in rows]
+        column_type = get_column_type(values)
+        columns.append({"name": column_name, "type": column_type, "blobs": []})
+        for blob in get_blobs(column_type, values):
+            columns[-1]["blobs"].append(len(blobs))
+            blobs.append(blob)
+
+    # blob positions depend on the header length, so they are stored as relative offsets
+    blob_positions = []
+    position = 0
+    for blob in blobs:
+        blob_positions.append([position, len(blob)])
+        position += (len(blob) + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+    header = json.dumps({"input_file_type": input_file_type,
+                         "num_rows": len(rows),
+                         "byteorder": sys.byteorder,
+                         "columns": columns,
+                         "blobs": blob_positions}, ensure_ascii=False).encode("utf-8")
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % ALIGNMENT)
+
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+            f.write(b"\0" * (-len(blob) % ALIGNMENT))
+    os.replace(tmp_file, output_file)
+
+
+class StringColumn(object):
+    def __init__(self, offsets, data, is_json=False):
+        self._offsets = offsets
+        self._data = data
+        self._is_json = is_json
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        string = str(self._data[self._offsets[idx]:self._offsets[idx + 1]], "utf-8")
+        return json.loads(string) if self._is_json else string
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+# a columnar file opened with mmap: numeric columns are memoryviews over the file
+# and strings are decoded only when accessed, so several processes can share one copy in the page cache
+class ColumnarDataset(object):
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a columnar dataset file")
+        header_length, = struct.unpack("<Q", buffer[len(MAGIC):len(MAGIC) + 8])
+        data_start = len(MAGIC) + 8 + header_length
+        header = json.loads(bytes(buffer[len(MAGIC) + 8:data_start]))
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was written on a {header['byteorder']}-endian machine")
+
+        self.input_file_type = header["input_file_type"]
+        self._num_rows = header["num_rows"]
+
+        blobs = [buffer[data_start + start:data_start + start + length] for start, length in header["blobs"]]
+        self._columns = {}
+        for column in header["columns"]:
+            column_blobs = [blobs[idx] for idx in column["blobs"]]
+            if column["type"] in NUMERIC_TYPECODES:
+                self._columns[column["name"]] = column_blobs[0].cast(NUMERIC_TYPECODES[column["type"]])
+            else:
+                self._columns[column["name"]] = StringColumn(column_blobs[0].cast("Q"), column_blobs[1],
+                                                             is_json=column["type"] == "json")
+        self.column_names = [column["name"] for column in header["columns"]]
+
+    def __len__(self):
+        return self._num_rows
+
+    def column(self, column_name):
+        return self._columns[column_name]
+
+    def __getitem__(self, idx):
+        return {column_name: self._columns[column_name][idx] for column_name in self.column_names}
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def dump(self, f):
+        dump_rows(self, self.input_file_type, f)
+
+    def close(self):
+        # memoryviews over the mmap have to be released before closing it
+        self._columns = {}
+        self._mmap.close()
+        self._file.close()
+
+
+def verify_round_trip(input_file, output_file):
+    dataset = ColumnarDataset(output_file)
+    output = io.StringIO()
+    dataset.dump(output)
+    dataset.close()
+    with open(input_file, "r", encoding="utf-8") as f:
+        if f.read() != output.getvalue():
+            raise ValueError(f"{output_file} does not round-trip to {input_file}")
+
+
+def convert(input_file, input_file_type, output_file):
+    write_columnar_file(read_rows(input_file, input_file_type), input_file_type, output_file)
+    verify_round_trip(input_file, output_file)
+
+
+def main(args):
+    if args.command == "convert":
+        convert(args.input_file, args.input_file_type, args.output_file)
+    elif args.command == "convert-all":
+        datasets = json.load(open(args.datasets_json))
+        for dataset in datasets:
+            for basename_key in ("train_file_basename", "valid_file_basename", "test_file_basename"):
+                input_file = os.path.join(args.data_dir, dataset["dirname"], dataset[basename_key])
+                if not os.path.exists(input_file):
+                    continue
+                output_file = os.path.splitext(input_file)[0] + ".col"
+                convert(input_file, dataset["input-file-type"], output_file)
+                print(f"{input_file} -> {output_file}", file=sys.stderr)
+    elif args.command == "dump":
+        dataset = ColumnarDataset(args.input_file)
+        dataset.dump(sys.stdout)
+        dataset.close()
+
+
+if __name__ == "__main__":
+    sys.stdin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+
+    parser = argparse.ArgumentParser(description="convert JGLUE datasets to memory-mappable columnar files.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser("convert", help="convert a dataset file")
+    convert_parser.add_argument("--input-file", type=str, required=True, help="input file")
+    convert_parser.add_argument("--input-file-type", choices=["json", "squad_json"], default="json")
+    convert_parser.add_argument("--output-file", type=str, required=True, help="output columnar file")
+
+    convert_all_parser = subparsers.add_parser("convert-all", help="convert all the datasets in datasets.json")
+    convert_all_parser.add_argument("--datasets-json", type=str, required=True, help="json for datasets")
+    convert_all_parser.add_argument("--data-dir", type=str, required=True, help="data dir")
+
+    dump_parser = subparsers.add_parser("dump", help="dump a columnar file as the original json")
+    dump_parser.add_argument("--input-file", type=str, required=True, help="input columnar file")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import math
+import cProfile
+from collections import Counter
+from contextlib import contextmanager
+
+
+# counters are plain string keys of a Counter, and latency histograms are ("latency", name, bucket) keys,
+# so that the stats of worker processes can be returned as a Counter and merged with update()
+def observe_latency(stats, name, seconds):
+    # power-of-two buckets from 1/8 ms: the bucket is the upper bound in ms
+    milliseconds = seconds * 1000
+    bucket = 0.125 if milliseconds <= 0.125 else 2 ** math.ceil(math.log2(milliseconds))
+    stats[("latency", name, bucket)] += 1
+
+
+def get_histogram_summary(buckets):
+    total = sum(buckets.values())
+    summary = {"count": total, "buckets_ms": {str(bucket): count for bucket, count in sorted(buckets.items())}}
+    for q in (50, 90, 99):
+        cumulative = 0
+        for bucket, count in sorted(buckets.items()):
+            cumulative += count
+            if cumulative >= total * q / 100:
+                summary[f"p{q}_ms_le"] = bucket
+                break
+    return summary
+
+
+# a text file wrapper counting the bytes written, for outputs that are not regular files (e.g. stdout)
+class CountingWriter(object):
+    def __init__(self, f, encoding="utf-8"):
+        self._file = f
+        self._encoding = encoding
+        self.bytes_written = 0
+
+    def write(self, s):
+        self.bytes_written += len(s.encode(self._encoding, errors="surrogateescape"))
+        return self._file.write(s)
+
+    def flush(self):
+        self._file.flush()
+
+
+class Instrumentation(object):
+    def __init__(self, name, progress_interval=None, report_file=None, profile_dir=None, file=None):
+        self._name = name
+        self._progress_interval = progress_interval
+        self._report_file = report_file
+        self._profile_dir = profile_dir
+        # sys.stderr may be replaced after this module is imported
+        self._file = file if file is not None else sys.stderr
+
+        self.stats = Counter()
+        self._stage_seconds = Counter()
+        self._profiling = False
+
+        self._start_time = time.time()
+        self._last_progress_time = self._start_time
+
+    def count(self, name, num=1):
+        self.stats[name] += num
+
+    def update(self, stats):
+        self.stats.update(stats)
+
+    @contextmanager
+    def stage(self, name):
+        profiler = None
+        # cProfile cannot be nested, so only the outermost stage is profiled
+        if self._profile_dir is not None and self._profiling is False:
+            profiler = cProfile.Profile()
+            self._profiling = True
+            profiler.enable()
+
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self._stage_seconds[name] += time.time() - start_time
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                os.makedirs(self._profile_dir, exist_ok=True)
+                # pstats format, readable by pstats, snakeviz, etc.
+                profiler.dump_stats(os.path.join(self._profile_dir, f"{self._name}.{name}.{os.getpid()}.prof"))
+
+    def get_counters(self):
+        return dict(sorted((key, value) for key, value in self.stats.items() if isinstance(key, str)))
+
+    def maybe_print_progress(self):
+        if self._progress_interval is None:
+            return
+        now = time.time()
+        if now - self._last_progress_time < self._progress_interval:
+            return
+        self._last_progress_time = now
+        counters = " ".join(f"{key}={value}" for key, value in self.get_counters().items())
+        print(f"[{self._name}] {now - self._start_time:.1f}s {counters}", file=self._file)
+
+    def get_report(self):
+        histograms = {}
+        for key, count in self.stats.items():
+            if isinstance(key, tuple) and key[0] == "latency":
+                histograms.setdefault(key[1], Counter())[key[2]] += count
+
+        return {"name": self._name,
+                "elapsed_sec": time.time() - self._start_time,
+                "stage_sec": dict(self._stage_seconds),
+                "counters": self.get_counters(),
+                "latency": {name: get_histogram_summary(buckets) for name, buckets in sorted(histograms.items())}}
+
+    # the final machine-readable report: a json line to stderr and optionally a json file
+    def report(self):
+        report = self.get_report()
+        print(json.dumps(report, ensure_ascii=False), file=self._file)
+        if self._report_file is not None:
+            with open(self._report_file, "w") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        return report
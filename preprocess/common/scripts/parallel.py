@@ -0,0 +1,13 @@
+from collections import deque
+
+
+# like Pool.imap, but keeps at most max_pending items (e.g. chunks of rows) in flight so that the input is not
+# read ahead; the results come back in the original order
+def imap_bounded(pool, func, iterable, max_pending):
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
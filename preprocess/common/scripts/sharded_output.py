@@ -0,0 +1,147 @@
+import os
+import json
+import gzip
+import bisect
+
+FORMAT = "sharded_jsonl"
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+INDEX_EXTENSION = ".index.json"
+
+
+# the index of the shards of an output is written next to it with a name of its own, so that a reader of
+# json lines (e.g. load_dataset("json") of run_glue.py) given the output path fails instead of reading the index
+def get_index_path(output_path):
+    if output_path.endswith(INDEX_EXTENSION):
+        return output_path
+    return output_path + INDEX_EXTENSION
+
+
+def compress(data, compression):
+    if compression == "gzip":
+        # mtime=0 so that the same records give the same bytes
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    elif compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    else:
+        raise ValueError(f"unknown compression: {compression}")
+
+
+def decompress(data, compression):
+    if compression == "gzip":
+        return gzip.decompress(data)
+    elif compression == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raise ValueError(f"unknown compression: {compression}")
+
+
+# Writes json lines as shards of shard_size lines, each compressed as an independent gzip member/zstd frame.
+# The shards are concatenated into one data file output_path + .gz/.zst, so "zcat"/"zstdcat" of the data file
+# gives the whole json lines file, and the index written at output_path + .index.json has the byte offset,
+# length and number of records of each shard, so that a reader can seek to a shard and decompress it alone.
+# Has the write interface of a text file, so that it can be given to print.
+class ShardedWriter(object):
+    def __init__(self, output_path, shard_size=10000, compression="gzip"):
+        self.name = output_path
+        self.index_path = get_index_path(output_path)
+        self.data_path = output_path + COMPRESSION_EXTENSIONS[compression]
+        self._shard_size = shard_size
+        self._compression = compression
+
+        self._f = open(self.data_path, "wb")
+        self._shards = []
+        self._lines = []
+        self._partial_line = ""
+        self.record_num = 0
+        self.bytes_written = 0
+
+    def write(self, string):
+        lines = (self._partial_line + string).split("\n")
+        self._partial_line = lines.pop()
+        for line in lines:
+            self._lines.append(line)
+            if len(self._lines) == self._shard_size:
+                self._write_shard()
+
+    def _write_shard(self):
+        data = compress("".join(line + "\n" for line in self._lines).encode("utf-8"), self._compression)
+        self._f.write(data)
+        self._shards.append(dict(offset=self.bytes_written, length=len(data),
+                                 first_record=self.record_num, record_num=len(self._lines)))
+        self.record_num += len(self._lines)
+        self.bytes_written += len(data)
+        self._lines = []
+
+    def close(self):
+        if self._partial_line != "":
+            self.write("\n")
+        if len(self._lines) > 0:
+            self._write_shard()
+        self._f.close()
+
+        index = dict(format=FORMAT,
+                     compression=self._compression,
+                     data_file=os.path.basename(self.data_path),
+                     record_num=self.record_num,
+                     shard_size=self._shard_size,
+                     shards=self._shards)
+        # the index is written last, so a complete index always points to complete shards
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(index, f, indent=1)
+            f.write("\n")
+        os.replace(self.index_path + ".tmp", self.index_path)
+        # an unsharded output (or an index written at the output path by an older version) of an earlier run
+        # would be read instead of the shards
+        if self.name != self.index_path and os.path.exists(self.name):
+            os.remove(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Reads the json lines (strings without "\n") written by ShardedWriter, given the output path or its index path.
+# Shards are independent, so they can be read by several processes with read_shard.
+class ShardedReader(object):
+    def __init__(self, path):
+        index_path = get_index_path(path)
+        with open(index_path, "r") as f:
+            self.index = json.load(f)
+        if self.index.get("format") != FORMAT:
+            raise ValueError(f"{index_path} is not an index of sharded json lines")
+        self.data_path = os.path.join(os.path.dirname(index_path), self.index["data_file"])
+        self._first_records = [shard["first_record"] for shard in self.index["shards"]]
+        self._cached_shard = (None, None)
+
+    def __len__(self):
+        return self.index["record_num"]
+
+    @property
+    def shard_num(self):
+        return len(self.index["shards"])
+
+    def read_shard(self, shard_idx):
+        shard = self.index["shards"][shard_idx]
+        with open(self.data_path, "rb") as f:
+            f.seek(shard["offset"])
+            data = f.read(shard["length"])
+        return decompress(data, self.index["compression"]).decode("utf-8").split("\n")[:-1]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(idx)
+        shard_idx = bisect.bisect_right(self._first_records, idx) - 1
+        if self._cached_shard[0] != shard_idx:
+            self._cached_shard = (shard_idx, self.read_shard(shard_idx))
+        return self._cached_shard[1][idx - self._first_records[shard_idx]]
+
+    def __iter__(self):
+        for shard_idx in range(self.shard_num):
+            yield from self.read_shard(shard_idx)
+
@@ -6,11 +6,23 @@ import json
 import csv
 import string
 import random
-from collections import defaultdict
+import time
+import hashlib
+import functools
+import heapq
+import multiprocessing
+import tempfile
+from array import array
+from collections import Counter, defaultdict
 from bs4 import BeautifulSoup
 
 import zenhan
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common", "scripts"))
+from instrumentation import Instrumentation
+from parallel import imap_bounded
+from sharded_output import ShardedWriter
+
 csv.field_size_limit(1000000)
 
 
@@ -37,21 +49,21 @@ def get_label(rating,
 
 
 def get_filter_review_id_list(args):
-    filter_review_id_list = defaultdict(list)
+    filter_review_id_list = defaultdict(set)
 
     if args.filter_review_id_list_valid is not None:
         with open(args.filter_review_id_list_valid, "r") as f:
-            filter_review_id_list["valid"] = [line.rstrip() for line in f]
+            filter_review_id_list["valid"] = {line.rstrip() for line in f}
 
     if args.filter_review_id_list_test is not None:
         with open(args.filter_review_id_list_test, "r") as f:
-            filter_review_id_list["test"] = [line.rstrip() for line in f]
+            filter_review_id_list["test"] = {line.rstrip() for line in f}
 
     return filter_review_id_list
 
 
 def get_label_conv_review_id_list(args):
-    label_conv_review_id_list = defaultdict(list)
+    label_conv_review_id_list = defaultdict(dict)
 
     if args.label_conv_review_id_list_valid is not None:
         with open(args.label_conv_review_id_list_valid, "r") as f:
@@ -64,96 +76,381 @@ def get_label_conv_review_id_list(args):
     return label_conv_review_id_list
 
 
-def output_data(instances, args):
-    os.makedirs(args.output_dir, exist_ok=True)
+def get_watched_review_ids(filter_review_id_list, label_conv_review_id_list):
+    watched_review_ids = set()
+    for eval_type in ("valid", "test"):
+        watched_review_ids.update(filter_review_id_list.get(eval_type, ()))
+        watched_review_ids.update(label_conv_review_id_list.get(eval_type, ()))
+    return watched_review_ids
 
-    instance_num = len(instances)
 
-    split_instances = {}
+# every review id in the filter/label conv lists of valid (test) must not appear in the other sets
+def check_split_leakage(split_review_ids, filter_review_id_list, label_conv_review_id_list):
+    for list_eval_type in ("valid", "test"):
+        listed_review_ids = set(filter_review_id_list.get(list_eval_type, ())) | \
+            set(label_conv_review_id_list.get(list_eval_type, ()))
+        for eval_type, review_ids in split_review_ids.items():
+            if eval_type == list_eval_type:
+                continue
+            leaked_review_ids = listed_review_ids & review_ids
+            assert len(leaked_review_ids) == 0, \
+                f"review ids for the {list_eval_type} set found in the {eval_type} set: {sorted(leaked_review_ids)[:10]}"
 
-    length1 = int(instance_num * args.split_ratio[0])
-    split_instances["train"] = instances[:length1]
 
-    length2 = int(instance_num * (args.split_ratio[0] + args.split_ratio[1]))
-    split_instances["valid"] = instances[length1:length2]
-    split_instances["test"] = instances[length2:]
+def convert_instance(instance, eval_type, filter_review_id_list, label_conv_review_id_list):
+    # filter
+    if instance["review_id"] in filter_review_id_list.get(eval_type, ()):
+        return None
+
+    # convert labels
+    conv_label = label_conv_review_id_list.get(eval_type, {}).get(instance["review_id"])
+    if conv_label is not None:
+        assert instance["label"] != conv_label
+        # update
+        instance["label"] = conv_label
+
+    if eval_type == "test":
+        del instance["label"]
+
+    return instance
 
-    filter_review_id_list = get_filter_review_id_list(args)
-    label_conv_review_id_list = get_label_conv_review_id_list(args)
 
+def get_output_files(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    out_files = {}
     for eval_type in ("train", "valid", "test"):
         if args.output_testset is False and eval_type == "test":
             continue
-
         out_file = os.path.join(args.output_dir, "{}-v{}.json".format(eval_type, args.version))
-        with open(out_file, mode="w") as f:
-            for instance in split_instances[eval_type]:
-                # filter
-                if len(filter_review_id_list) != 0:
-                    filter_flag = False
-                    for filter_eval_type in ("valid", "test"):
-                        if eval_type == filter_eval_type and instance["review_id"] in filter_review_id_list[filter_eval_type]:
-                            filter_flag = True
-                        if eval_type != filter_eval_type:
-                            if filter_eval_type in filter_review_id_list:
-                                assert instance["review_id"] not in filter_review_id_list[filter_eval_type]
-
-                    if filter_flag is True:
-                        continue
-
-                # convert labels
-                if len(label_conv_review_id_list) != 0:
-                    for conv_eval_type in ("valid", "test"):
-                        if eval_type == conv_eval_type and instance["review_id"] in label_conv_review_id_list[conv_eval_type]:
-                            assert instance["label"] != label_conv_review_id_list[conv_eval_type][instance["review_id"]]
-                            # update
-                            instance["label"] = label_conv_review_id_list[conv_eval_type][instance["review_id"]]
-
-                        if eval_type != conv_eval_type:
-                            if conv_eval_type in label_conv_review_id_list:
-                                assert instance["review_id"] not in label_conv_review_id_list[conv_eval_type]
-
-                if eval_type == "test":
-                    del instance["label"]
-
-                print(json.dumps(instance, ensure_ascii=False), file=f)
+        if args.shard_size is not None:
+            out_files[eval_type] = ShardedWriter(out_file, shard_size=args.shard_size, compression=args.shard_compression)
+        else:
+            out_files[eval_type] = open(out_file, mode="w")
 
+    return out_files
 
-def main(args):
-    reader = csv.reader(sys.stdin, delimiter="\t")
-    next(reader)
 
-    instances = []
-    instance_num = 0
-    for row in reader:
-        text = row[13]
-        rating = int(row[7])
-        review_id = row[2]
-        label = get_label(rating,
-                          positive_negative=args.positive_negative)
-        if label is None:
-            continue
+def print_filtering_time(start_time, check_time, end_time, instance_num, filtered_num):
+    print(f"filtering: {instance_num} instances, {filtered_num} filtered, "
+          f"leakage check {check_time - start_time:.3f} sec, "
+          f"filter/convert/output {end_time - check_time:.3f} sec", file=sys.stderr)
 
-        text = BeautifulSoup(text, "html.parser").get_text()
-        if is_filtered_by_ascii_rate(text):
-            continue
-        if args.max_char_length is not None and len(text) > args.max_char_length:
+
+def close_output_files(out_files, instrumentation):
+    for f in out_files.values():
+        f.close()
+        if isinstance(f, ShardedWriter):
+            instrumentation.count("bytes_written", f.bytes_written)
+        else:
+            instrumentation.count("bytes_written", os.path.getsize(f.name))
+
+
+# the eval type of the idx-th of instance_num shuffled instances
+def get_split_eval_type_func(instance_num, split_ratio):
+    length1 = int(instance_num * split_ratio[0])
+    length2 = int(instance_num * (split_ratio[0] + split_ratio[1]))
+
+    def get_eval_type(idx):
+        if idx < length1:
+            return "train"
+        elif idx < length2:
+            return "valid"
+        else:
+            return "test"
+
+    return get_eval_type
+
+
+def output_data(instances, args, filter_review_id_list, label_conv_review_id_list, instrumentation):
+    instance_num = len(instances)
+    get_eval_type = get_split_eval_type_func(instance_num, args.split_ratio)
+
+    out_files = get_output_files(args)
+
+    start_time = time.time()
+    if isinstance(instances, SpilledInstances):
+        watched_positions = instances.get_watched_positions()
+    else:
+        watched_review_ids = get_watched_review_ids(filter_review_id_list, label_conv_review_id_list)
+        watched_positions = [(idx, instance["review_id"]) for idx, instance in enumerate(instances)
+                             if instance["review_id"] in watched_review_ids]
+    split_review_ids = {eval_type: set() for eval_type in out_files}
+    for idx, review_id in watched_positions:
+        if get_eval_type(idx) in split_review_ids:
+            split_review_ids[get_eval_type(idx)].add(review_id)
+    check_split_leakage(split_review_ids, filter_review_id_list, label_conv_review_id_list)
+    check_time = time.time()
+
+    # instances may be a disk-backed sequence, so the splits are taken in one sequential pass
+    filtered_num = 0
+    for idx, instance in enumerate(instances):
+        eval_type = get_eval_type(idx)
+        if eval_type not in out_files:
             continue
 
-        if args.h2z is True:
-            text = zenhan.h2z(text)
+        instance = convert_instance(instance, eval_type, filter_review_id_list, label_conv_review_id_list)
+        if instance is not None:
+            print(json.dumps(instance, ensure_ascii=False), file=out_files[eval_type])
+        else:
+            filtered_num += 1
+
+    close_output_files(out_files, instrumentation)
+    instrumentation.count("instances_filtered_by_list", filtered_num)
+
+    print_filtering_time(start_time, check_time, time.time(), instance_num, filtered_num)
 
-        instances.append(dict(sentence=text, label=label, review_id=review_id))
+
+# split by a hash of review_id, so that no instance has to be kept in memory
+def get_hash_eval_type(review_id, split_ratio):
+    value = int(hashlib.md5(review_id.encode("utf-8")).hexdigest(), 16) / (1 << 128)
+    if value < split_ratio[0]:
+        return "train"
+    elif value < split_ratio[0] + split_ratio[1]:
+        return "valid"
+    else:
+        return "test"
+
+
+# review ids listed for the valid/test sets are pinned to that set, so no leakage check is needed
+def get_pinned_eval_types(filter_review_id_list, label_conv_review_id_list):
+    pinned_eval_types = {}
+    for eval_type in ("valid", "test"):
+        for review_id in filter_review_id_list.get(eval_type, ()):
+            pinned_eval_types[review_id] = eval_type
+        for review_id in label_conv_review_id_list.get(eval_type, ()):
+            pinned_eval_types[review_id] = eval_type
+    return pinned_eval_types
+
+
+def output_data_by_hash(instances, args, filter_review_id_list, label_conv_review_id_list, instrumentation):
+    pinned_eval_types = get_pinned_eval_types(filter_review_id_list, label_conv_review_id_list)
+
+    out_files = get_output_files(args)
+
+    start_time = time.time()
+    instance_num = 0
+    filtered_num = 0
+    for instance in instances:
         instance_num += 1
+        eval_type = pinned_eval_types.get(instance["review_id"])
+        if eval_type is None:
+            eval_type = get_hash_eval_type(instance["review_id"], args.split_ratio)
+
+        if eval_type not in out_files:
+            continue
+
+        instance = convert_instance(instance, eval_type, filter_review_id_list, label_conv_review_id_list)
+        if instance is not None:
+            print(json.dumps(instance, ensure_ascii=False), file=out_files[eval_type])
+        else:
+            filtered_num += 1
+
+    close_output_files(out_files, instrumentation)
+    instrumentation.count("instances_filtered_by_list", filtered_num)
+
+    # instances are cleaned while being output, so this includes the cleaning time
+    print_filtering_time(start_time, start_time, time.time(), instance_num, filtered_num)
+
+
+# instances spilled to a temporary file, and output in the shuffled order by an external sort:
+# the spill file is read sequentially into sorted runs of at most run_size bytes of instances,
+# which are spilled again and merged, so only a position per instance (8 bytes) is kept in memory
+class SpilledInstances(object):
+    def __init__(self, instances, tmp_dir=None, run_size=256 * 1024 * 1024, watched_review_ids=()):
+        self._tmp_dir = tmp_dir
+        self._run_size = run_size
+        self._file = tempfile.TemporaryFile(mode="w+b", dir=tmp_dir)
+        self._instance_num = 0
+        # (index, review_id) of the instances listed in the filter/label conv lists, for the leakage check
+        self._watched = []
+        for instance in instances:
+            if instance["review_id"] in watched_review_ids:
+                self._watched.append((self._instance_num, instance["review_id"]))
+            self._file.write(json.dumps(instance, ensure_ascii=False).encode("utf-8") + b"\n")
+            self._instance_num += 1
+        # positions[idx]: position of the idx-th instance in the shuffled order
+        self._positions = None
+
+    def __len__(self):
+        return self._instance_num
+
+    def shuffle(self, seed):
+        # random.shuffle only depends on the length of the sequence,
+        # so shuffling indices gives the same permutation as shuffling the instances themselves
+        order = array("Q", range(self._instance_num))
+        random.seed(seed)
+        random.shuffle(order)
+        self._positions = array("Q", bytes(8 * self._instance_num))
+        for position, idx in enumerate(order):
+            self._positions[idx] = position
+
+    def get_watched_positions(self):
+        if self._positions is None:
+            return list(self._watched)
+        return [(self._positions[idx], review_id) for idx, review_id in self._watched]
+
+    def _write_run(self, run):
+        run.sort()
+        run_file = tempfile.TemporaryFile(mode="w+b", dir=self._tmp_dir)
+        for position, line in run:
+            run_file.write(b"%d\t%s" % (position, line))
+        run_file.seek(0)
+        return run_file
+
+    @staticmethod
+    def _read_run(run_file):
+        for line in run_file:
+            position, line = line.split(b"\t", 1)
+            yield int(position), line
+
+    def __iter__(self):
+        self._file.seek(0)
+        if self._positions is None:
+            for line in self._file:
+                yield json.loads(line)
+            return
+
+        run_files, run, run_size = [], [], 0
+        for idx, line in enumerate(self._file):
+            run.append((self._positions[idx], line))
+            run_size += len(line)
+            if run_size >= self._run_size:
+                run_files.append(self._write_run(run))
+                run, run_size = [], 0
+        # the last run is merged from memory
+        run.sort()
+        runs = [self._read_run(run_file) for run_file in run_files] + [iter(run)]
+        # the positions are unique, so the lines are never compared
+        for _, line in heapq.merge(*runs):
+            yield json.loads(line)
+        for run_file in run_files:
+            run_file.close()
+
+    def close(self):
+        self._file.close()
+
+
+def clean_row(row, positive_negative=False, max_char_length=None, h2z=False, stats=None):
+    # stats counts why rows are filtered out
+    if stats is None:
+        stats = Counter()
+
+    text = row[13]
+    rating = int(row[7])
+    review_id = row[2]
+    label = get_label(rating,
+                      positive_negative=positive_negative)
+    if label is None:
+        stats["rows_filtered_by_label"] += 1
+        return None
+
+    text = BeautifulSoup(text, "html.parser").get_text()
+    if is_filtered_by_ascii_rate(text):
+        stats["rows_filtered_by_ascii_rate"] += 1
+        return None
+    if max_char_length is not None and len(text) > max_char_length:
+        stats["rows_filtered_by_length"] += 1
+        return None
+
+    if h2z is True:
+        text = zenhan.h2z(text)
+
+    return dict(sentence=text, label=label, review_id=review_id)
+
+
+def clean_rows(rows, positive_negative=False, max_char_length=None, h2z=False):
+    stats = Counter(rows_read=len(rows))
+    instances = [clean_row(row, positive_negative=positive_negative, max_char_length=max_char_length, h2z=h2z,
+                           stats=stats)
+                 for row in rows]
+    return instances, stats
+
+
+def get_row_chunks(reader, chunk_size):
+    rows = []
+    for row in reader:
+        rows.append(row)
+        if len(rows) == chunk_size:
+            yield rows
+            rows = []
+    if len(rows) > 0:
+        yield rows
+
+
+def read_instances(args, instrumentation):
+    reader = csv.reader(sys.stdin, delimiter="\t")
+    next(reader)
+
+    clean_kwargs = dict(positive_negative=args.positive_negative,
+                        max_char_length=args.max_char_length,
+                        h2z=args.h2z)
+
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        chunk_results = imap_bounded(pool, functools.partial(clean_rows, **clean_kwargs),
+                                     get_row_chunks(reader, args.chunk_size), args.workers * 2)
+    else:
+        chunk_results = (clean_rows(rows, **clean_kwargs) for rows in get_row_chunks(reader, args.chunk_size))
+
+    try:
+        instance_num = 0
+        for chunk_instances, chunk_stats in chunk_results:
+            instrumentation.update(chunk_stats)
+            instrumentation.maybe_print_progress()
+            for instance in chunk_instances:
+                if instance is None:
+                    continue
+
+                yield instance
+                instance_num += 1
+                instrumentation.count("instances")
+
+                if args.max_instance_num is not None:
+                    if instance_num == args.max_instance_num:
+                        return
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def main(args):
+    instrumentation = Instrumentation("marc-ja", progress_interval=args.progress_interval,
+                                      report_file=args.report_file, profile_dir=args.profile_dir)
+
+    # the filter/label conv lists are loaded once as hashed sets/dicts
+    filter_review_id_list = get_filter_review_id_list(args)
+    label_conv_review_id_list = get_label_conv_review_id_list(args)
+
+    if args.split_method == "hash":
+        # instances are cleaned while being output
+        with instrumentation.stage("clean_output"):
+            output_data_by_hash(read_instances(args, instrumentation), args,
+                                filter_review_id_list, label_conv_review_id_list, instrumentation)
+    elif args.spill_dir is not None:
+        with instrumentation.stage("clean"):
+            instances = SpilledInstances(read_instances(args, instrumentation), tmp_dir=args.spill_dir,
+                                         run_size=args.spill_run_size,
+                                         watched_review_ids=get_watched_review_ids(filter_review_id_list,
+                                                                                   label_conv_review_id_list))
+        with instrumentation.stage("shuffle"):
+            instances.shuffle(1)
+        with instrumentation.stage("output"):
+            output_data(instances, args, filter_review_id_list, label_conv_review_id_list, instrumentation)
+        instances.close()
+    else:
+        with instrumentation.stage("clean"):
+            instances = list(read_instances(args, instrumentation))
 
-        if args.max_instance_num is not None:
-            if instance_num == args.max_instance_num:
-                break
+        with instrumentation.stage("shuffle"):
+            random.seed(1)
+            random.shuffle(instances)
 
-    random.seed(1)
-    random.shuffle(instances)
+        with instrumentation.stage("output"):
+            output_data(instances, args, filter_review_id_list, label_conv_review_id_list, instrumentation)
 
-    output_data(instances, args)
+    instrumentation.report()
 
 
 if __name__ == "__main__":
@@ -174,6 +471,20 @@ if __name__ == "__main__":
     parser.add_argument("--filter-review-id-list-test", type=str, default=None, help="filter review id list for test set")
     parser.add_argument("--label-conv-review-id-list-valid", type=str, default=None, help="label conv review id list for validation set")
     parser.add_argument("--label-conv-review-id-list-test", type=str, default=None, help="label conv review id list for test set")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes for cleaning reviews")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="number of rows sent to a worker at once")
+    parser.add_argument("--split-method", choices=["shuffle", "hash"], default="shuffle",
+                        help="shuffle: random.seed(1) shuffle (default), hash: streaming split by a hash of review_id")
+    parser.add_argument("--spill-dir", type=str, default=None,
+                        help="spill instances to a temporary file under this dir for the shuffle split (same split as in memory)")
+    parser.add_argument("--spill-run-size", type=int, default=256 * 1024 * 1024,
+                        help="max bytes of spilled instances held in memory while restoring the shuffled order")
+    parser.add_argument("--shard-size", type=int, default=None,
+                        help="write each split as compressed shards of N lines and an index (see ../../common/README.md)")
+    parser.add_argument("--shard-compression", choices=["gzip", "zstd"], default="gzip", help="compression of the shards")
+    parser.add_argument("--progress-interval", type=float, default=None, help="print a progress line to stderr every N seconds")
+    parser.add_argument("--report-file", type=str, default=None, help="write the final counters/timers report as json")
+    parser.add_argument("--profile-dir", type=str, default=None, help="write cProfile output of each stage under this dir")
 
     args = parser.parse_args()
     args.split_ratio = [float(f) for f in args.split_ratio]
@@ -0,0 +1,230 @@
+import os
+import io
+import sys
+import argparse
+import json
+import signal
+import socket
+import socketserver
+import threading
+import multiprocessing
+from collections import Counter
+
+from morphological_analyzer import MorphologicalAnalyzer
+
+
+# A resident tokenization server, so that pyknp/MeCab and the dictionaries (and the Juman++ model) are loaded once
+# instead of once per make target.
+# The protocol is newline-delimited json over a unix domain socket:
+#   request:  {"analyzer": "mecab", "mecab_dic_dir": null, "h2z": false, "strings": ["...", ...]}
+#   response: {"tokenized_strings": ["...", null, ...], "stats": {"lru_hits": 0, ...},
+#              "latencies": [seconds of each string analyzed (not found in the cache), ...]}
+#             or {"error": "..."}
+# One pool of warm analyzers is kept per (analyzer, dic dir, h2z).
+
+
+def get_config_key(analyzer, mecab_dic_dir, h2z):
+    return (analyzer, os.path.abspath(mecab_dic_dir) if mecab_dic_dir is not None else None, bool(h2z))
+
+
+# one analyzer per worker process of a pool
+worker_morphological_analyzer = None
+
+
+def init_worker(analyzer_kwargs):
+    global worker_morphological_analyzer
+    worker_morphological_analyzer = MorphologicalAnalyzer(**analyzer_kwargs)
+
+
+def tokenize_in_worker(strings):
+    tokenized_strings = worker_morphological_analyzer.get_tokenized_strings(strings)
+    worker_morphological_analyzer.flush_cache()
+    return (tokenized_strings, worker_morphological_analyzer.pop_cache_stats(),
+            worker_morphological_analyzer.pop_latencies())
+
+
+def get_chunks(strings, chunk_num):
+    chunk_size = max((len(strings) + chunk_num - 1) // chunk_num, 1)
+    return [strings[i:i + chunk_size] for i in range(0, len(strings), chunk_size)]
+
+
+class AnalyzerPools(object):
+    def __init__(self, workers=1, cache_file=None, cache_lru_size=100000, timeout=30):
+        self._workers = workers
+        self._cache_file = cache_file
+        self._cache_lru_size = cache_lru_size
+        self._timeout = timeout
+
+        self._pools = {}
+        self._lock = threading.Lock()
+        # spawn, since the pools are created from the threads of the server
+        self._context = multiprocessing.get_context("spawn")
+
+    def _get_pool(self, config_key):
+        with self._lock:
+            if config_key not in self._pools:
+                analyzer, mecab_dic_dir, h2z = config_key
+                analyzer_kwargs = dict(analyzer=analyzer, mecab_dic_dir=mecab_dic_dir, h2z=h2z,
+                                       cache_file=self._cache_file, cache_lru_size=self._cache_lru_size,
+                                       timeout=self._timeout, record_latencies=True)
+                print(f"starting {self._workers} analyzer(s) for {config_key}", file=sys.stderr)
+                self._pools[config_key] = self._context.Pool(self._workers, initializer=init_worker,
+                                                             initargs=(analyzer_kwargs,))
+            return self._pools[config_key]
+
+    def tokenize(self, config_key, strings):
+        pool = self._get_pool(config_key)
+        # a batch is split across the workers, and the results come back in the original order
+        tokenized_strings, stats, latencies = [], Counter(), []
+        for chunk_tokenized_strings, chunk_stats, chunk_latencies in pool.map(tokenize_in_worker,
+                                                                              get_chunks(strings, self._workers)):
+            tokenized_strings.extend(chunk_tokenized_strings)
+            stats.update(chunk_stats)
+            latencies.extend(chunk_latencies)
+        return tokenized_strings, stats, latencies
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.terminate()
+                pool.join()
+            self._pools = {}
+
+
+class AnalyzerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode("utf-8"))
+                config_key = get_config_key(request["analyzer"], request.get("mecab_dic_dir"), request.get("h2z"))
+                tokenized_strings, stats, latencies = self.server.analyzer_pools.tokenize(config_key,
+                                                                                          request["strings"])
+                response = dict(tokenized_strings=tokenized_strings, stats=stats, latencies=latencies)
+            except Exception as e:
+                response = dict(error=f"{type(e).__name__}: {e}")
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class AnalyzerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, analyzer_pools):
+        self.analyzer_pools = analyzer_pools
+        super().__init__(socket_path, AnalyzerRequestHandler)
+
+
+# has the same tokenization interface as MorphologicalAnalyzer, but sends the strings to the server
+class AnalyzerClient(object):
+    def __init__(self, socket_path, analyzer, mecab_dic_dir=None, h2z=False, record_latencies=False):
+        self._config = dict(analyzer=analyzer,
+                            mecab_dic_dir=os.path.abspath(mecab_dic_dir) if mecab_dic_dir is not None else None,
+                            h2z=h2z)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile("rwb")
+        self._stats = Counter()
+        self._latencies = [] if record_latencies is True else None
+
+    def get_tokenized_string(self, string):
+        return self.get_tokenized_strings([string])[0]
+
+    def get_tokenized_strings(self, strings):
+        request = dict(self._config, strings=list(strings))
+        self._file.write(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+        self._file.flush()
+
+        line = self._file.readline()
+        if line == b"":
+            raise RuntimeError("analyzer server closed the connection")
+        response = json.loads(line.decode("utf-8"))
+        if "error" in response:
+            raise RuntimeError(f"analyzer server: {response['error']}")
+        self._stats.update(response["stats"])
+        if self._latencies is not None:
+            self._latencies.extend(response.get("latencies", []))
+        return response["tokenized_strings"]
+
+    def pop_latencies(self):
+        if self._latencies is None:
+            return []
+        latencies = self._latencies
+        self._latencies = []
+        return latencies
+
+    def pop_cache_stats(self):
+        stats = self._stats
+        self._stats = Counter()
+        return stats
+
+    def flush_cache(self):
+        # the server flushes the cache after each request
+        pass
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+def is_server_running(socket_path):
+    if not os.path.exists(socket_path):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(socket_path)
+        return True
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+
+
+def main(args):
+    if is_server_running(args.socket):
+        raise RuntimeError(f"an analyzer server is already running on {args.socket}")
+    if os.path.exists(args.socket):
+        # left by a server that was killed
+        os.remove(args.socket)
+
+    analyzer_pools = AnalyzerPools(workers=args.workers, cache_file=args.cache_file, cache_lru_size=args.cache_lru_size,
+                                   timeout=args.analyzer_timeout)
+    server = AnalyzerServer(args.socket, analyzer_pools)
+    # shut down cleanly (and remove the socket) on kill
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"serving on {args.socket}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        analyzer_pools.close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    sys.stdin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', line_buffering=True)
+
+    parser = argparse.ArgumentParser(description="serve morphological analysis over a unix domain socket.")
+    parser.add_argument("--socket",
+                        type=str,
+                        required=True,
+                        help="path of the unix domain socket")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="number of analyzer processes per (analyzer, dic dir, h2z)")
+    parser.add_argument("--cache-file",
+                        type=str,
+                        default=None,
+                        help="sqlite file for caching tokenized strings (shared across datasets and runs)")
+    parser.add_argument("--cache-lru-size",
+                        type=int,
+                        default=100000,
+                        help="number of tokenized strings kept in memory in front of the cache file")
+    parser.add_argument("--analyzer-timeout",
+                        type=int,
+                        default=30,
+                        help="seconds per call to juman/jumanpp, after which the process is restarted (default: 30)")
+    args = parser.parse_args()
+    main(args)
@@ -4,108 +4,380 @@ import sys
 import argparse
 import json
 import csv
+import functools
+import multiprocessing
+from collections import Counter
 
 from morphological_analyzer import MorphologicalAnalyzer
+from analyzer_server import AnalyzerClient, is_server_running
+from squad_json import SquadArticleReader, SquadArticleWriter, SquadCheckpoint
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common", "scripts"))
+from instrumentation import Instrumentation, CountingWriter, observe_latency
+from parallel import imap_bounded
+from sharded_output import ShardedWriter
+
+
+# The "analyzer_call" histogram has the latency of each string that the analyzer (of this process or of the
+# server) actually analyzed, so cache hits are not in it (they are counted as lru_hits/disk_hits).
+# None (including a juman/jumanpp analysis that failed) is counted as a parse error.
+def get_tokenized_strings(morphological_analyzer, strings, stats):
+    tokenized_strings = morphological_analyzer.get_tokenized_strings(strings)
+    for seconds in morphological_analyzer.pop_latencies():
+        observe_latency(stats, "analyzer_call", seconds)
+    stats["strings_analyzed"] += len(strings)
+    stats["parse_errors"] += sum(tokenized_string is None for tokenized_string in tokenized_strings)
+    return tokenized_strings
+
+
+def get_tokenized_string(morphological_analyzer, string, stats):
+    return get_tokenized_strings(morphological_analyzer, [string], stats)[0]
 
 
 # for JSQuAD
-# When title, question and context are tokenized, an answer_start position will be changed
-def get_answer_start(tokenized_answer, context):
+# When title, question and context are tokenized, an answer_start position will be changed.
+# Tokenization only inserts spaces, so positions are mapped through the non-space characters,
+# which are precomputed once per paragraph.
+class OffsetMap(object):
+    def __init__(self, text):
+        self.text = text
+        # offsets[i]: position in text of the i-th non-space character
+        self.offsets = [ptr for ptr, ch in enumerate(text) if not ch.isspace()]
+        self.stripped = "".join(text[ptr] for ptr in self.offsets)
+        self._nonspace_nums = None
+
+    # number of non-space characters before position
+    def get_nonspace_num(self, position):
+        if self._nonspace_nums is None:
+            self._nonspace_nums = [0] * (len(self.text) + 1)
+            for ptr, ch in enumerate(self.text):
+                self._nonspace_nums[ptr + 1] = self._nonspace_nums[ptr] + (0 if ch.isspace() else 1)
+        return self._nonspace_nums[min(max(position, 0), len(self.text))]
+
+
+def get_answer_start(tokenized_answer, tokenized_offset_map, expected_idx=None):
     answer = "".join(ch for ch in tokenized_answer if not ch.isspace())
+    if len(answer) == 0:
+        raise ValueError("empty answer")
 
-    context_strip, offsets = zip(*[(ch, ptr) for ptr, ch in enumerate(context) if not ch.isspace()])
-    idx = "".join(context_strip).index(answer)
+    stripped = tokenized_offset_map.stripped
+    if expected_idx is not None and stripped.startswith(answer, expected_idx):
+        idx = expected_idx
+    else:
+        # the characters have been changed (e.g. by h2z): take the occurrence nearest to the original position
+        idx = stripped.find(answer)
+        if idx == -1:
+            raise ValueError(f"{tokenized_answer} not found")
+        if expected_idx is not None:
+            next_idx = idx
+            while next_idx != -1 and next_idx <= expected_idx:
+                idx = next_idx
+                next_idx = stripped.find(answer, next_idx + 1)
+            if next_idx != -1 and next_idx - expected_idx < expected_idx - idx:
+                idx = next_idx
+
+    offsets = tokenized_offset_map.offsets
     answer_start, answer_end = offsets[idx], offsets[idx + len(answer) - 1]
-    tokenized_answer = context[answer_start:answer_end + 1]
+    tokenized_answer = tokenized_offset_map.text[answer_start:answer_end + 1]
 
     return tokenized_answer, answer_start
 
 
+def process_squad_article(article, morphological_analyzer, stats):
+    tokenized_title = get_tokenized_string(morphological_analyzer, article["title"], stats)
+
+    # for each paragraph
+    for paragraph in article["paragraphs"]:
+        title_context = paragraph["context"]
+        _, context = title_context.split(" [SEP] ")
+        tokenized_context = get_tokenized_string(morphological_analyzer, context, stats)
+
+        original_offset_map = OffsetMap(title_context)
+        tokenized_offset_map = OffsetMap(f"{tokenized_title} [SEP] {tokenized_context}")
+
+        # for each qa
+        for qa in paragraph["qas"]:
+            tokenized_question = get_tokenized_string(morphological_analyzer, qa["question"], stats)
+            # for each answer
+            for answer in qa["answers"]:
+                stats["answers"] += 1
+                tokenized_answer = get_tokenized_string(morphological_analyzer, answer["text"], stats)
+
+                try:
+                    expected_idx = original_offset_map.get_nonspace_num(answer["answer_start"])
+                    tokenized_answer, answer_start = get_answer_start(tokenized_answer,
+                                                                      tokenized_offset_map,
+                                                                      expected_idx=expected_idx)
+                    answer["text"] = tokenized_answer
+                    answer["answer_start"] = answer_start
+                except:
+                    stats["unaligned_answers"] += 1
+                    print(f"not found {answer} in {context}", file=sys.stderr)
+                    continue
+            qa["question"] = tokenized_question
+
+        paragraph["context"] = f"{tokenized_title} [SEP] {tokenized_context}"
+
+    article["title"] = tokenized_title
+
+    return article
+
+
+def print_unaligned_answer_report(stats):
+    print(f"unaligned answers: {stats['unaligned_answers']} / {stats['answers']}", file=sys.stderr)
+
+
 def process_squad_data(data, morphological_analyzer):
+    stats = Counter()
+
     # for each article
     for article in data:
-        tokenized_title = morphological_analyzer.get_tokenized_string(article["title"])
-
-        # for each paragraph
-        for paragraph in article["paragraphs"]:
-            title_context = paragraph["context"]
-            _, context = title_context.split(" [SEP] ")
-            tokenized_context = morphological_analyzer.get_tokenized_string(context)
-
-            # for each qa
-            for qa in paragraph["qas"]:
-                tokenized_question = morphological_analyzer.get_tokenized_string(qa["question"])
-                # for each answer
-                for answer in qa["answers"]:
-                    tokenized_answer = morphological_analyzer.get_tokenized_string(answer["text"])
-
-                    try:
-                        tokenized_answer, answer_start = get_answer_start(tokenized_answer,
-                                                                          tokenized_title + " [SEP] " + tokenized_context)
-                        answer["text"] = tokenized_answer
-                        answer["answer_start"] = answer_start
-                    except:
-                        print(f"not found {answer} in {context}", file=sys.stderr)
-                        continue
-                qa["question"] = tokenized_question
-
-            paragraph["context"] = f"{tokenized_title} [SEP] {tokenized_context}"
-
-        article["title"] = tokenized_title
+        process_squad_article(article, morphological_analyzer, stats)
+
+    print_unaligned_answer_report(stats)
 
     return data
 
 
-def main(args):
-    morphological_analyzer = MorphologicalAnalyzer(args.morphological_analyzer,
-                                                   mecab_dic_dir=args.mecab_dic_dir,
-                                                   h2z=args.h2z)
-
-    if args.input_file_type == "json":
-        for line in sys.stdin:
-            json_data = json.loads(line.rstrip("\n"))
-
-            for column_name in args.column_names:
-                string = json_data[column_name]
-                tokenized_string = morphological_analyzer.get_tokenized_string(string)
-
-                if tokenized_string is not None:
-                    json_data[column_name] = tokenized_string
-                else:
-                    print(f"skip: parse error {json_data}", file=sys.stderr)
-                    continue
-            try:
-                print(json.dumps(json_data, ensure_ascii=False))
-            except:
-                print(f"skip: {json_data}", file=sys.stderr)
+# items are (index, article), where article is None if it has been restored from the checkpoint
+# outputs are (index, original title, output string or None, counters of the article)
+def process_squad_articles(items, morphological_analyzer, column_names):
+    stats = Counter()
+    outputs = []
+    for idx, article in items:
+        if article is None:
+            outputs.append((idx, None, None, None))
+            continue
+
+        title = article["title"]
+        article_stats = Counter(articles_read=1)
+        output = json.dumps(process_squad_article(article, morphological_analyzer, article_stats), ensure_ascii=False)
+        stats.update(article_stats)
+        outputs.append((idx, title, output, {key: value for key, value in article_stats.items() if isinstance(key, str)}))
+    return outputs, [], stats
+
+
+def get_squad_items(articles, checkpoint):
+    for idx, article in enumerate(articles):
+        if checkpoint is not None and idx in checkpoint.finished:
+            if checkpoint.finished[idx]["title"] != article["title"]:
+                raise ValueError(f"{checkpoint.path} does not match the input at article {idx}")
+            yield idx, None
+        else:
+            yield idx, article
+
+
+# the articles are written in the input order, whether they are restored from the checkpoint or not,
+# so the output is the same as that of an uninterrupted run
+def write_squad_outputs(outputs, writer, checkpoint, instrumentation):
+    for idx, title, output, article_stats in outputs:
+        if output is None:
+            entry = checkpoint.finished[idx]
+            output = entry["article"]
+            instrumentation.update(entry["stats"])
+            instrumentation.count("articles_resumed")
+        elif checkpoint is not None:
+            checkpoint.append(idx, title, output, article_stats)
+        writer.write(output)
+    if checkpoint is not None:
+        checkpoint.flush()
+
+
+def process_json_lines(lines, morphological_analyzer, column_names):
+    stats = Counter(lines_read=len(lines))
+    json_data_list = [json.loads(line.rstrip("\n")) for line in lines]
+    # all the strings in a batch are sent to the analyzer at once
+    strings = [json_data[column_name] for json_data in json_data_list for column_name in column_names]
+    tokenized_strings = iter(get_tokenized_strings(morphological_analyzer, strings, stats))
+
+    outputs, messages = [], []
+    for json_data in json_data_list:
+        for column_name in column_names:
+            tokenized_string = next(tokenized_strings)
+
+            if tokenized_string is not None:
+                json_data[column_name] = tokenized_string
+            else:
+                messages.append(f"skip: parse error {json_data}")
                 continue
+        try:
+            outputs.append(json.dumps(json_data, ensure_ascii=False))
+        except:
+            messages.append(f"skip: {json_data}")
+            continue
 
-    elif args.input_file_type == "csv":
-        reader = csv.DictReader(sys.stdin)
+    return outputs, messages, stats
 
-        writer = csv.writer(sys.stdout)
-        writer.writerow(reader.fieldnames)
-        for row in reader:
-            for column_name in args.column_names:
-                string = row[column_name]
-                tokenized_string = morphological_analyzer.get_tokenized_string(string)
 
-                if tokenized_string is not None:
-                    row[column_name] = tokenized_string
-                else:
-                    print(f"skip: tokenization error {json_data}", file=sys.stderr)
-                    continue
+def process_csv_rows(rows, morphological_analyzer, column_names):
+    stats = Counter(lines_read=len(rows))
+    strings = [row[column_name] for row in rows for column_name in column_names]
+    tokenized_strings = iter(get_tokenized_strings(morphological_analyzer, strings, stats))
+
+    outputs, messages = [], []
+    for row in rows:
+        for column_name in column_names:
+            tokenized_string = next(tokenized_strings)
+
+            if tokenized_string is not None:
+                row[column_name] = tokenized_string
+            else:
+                messages.append(f"skip: tokenization error {row}")
+                continue
+
+        outputs.append(list(row.values()))
 
-            writer.writerow(row.values())
+    return outputs, messages, stats
 
-    elif args.input_file_type == "squad_json":
-        data = None
-        for line in sys.stdin:
-            json_data = json.loads(line)
-            data = json_data["data"]
 
-        processed_data = process_squad_data(data, morphological_analyzer)
-        print(json.dumps({"data": processed_data}, ensure_ascii=False))
+# a client of the analyzer server if it is running, otherwise an analyzer of this process
+def get_morphological_analyzer(analyzer_kwargs, server_socket=None):
+    if server_socket is not None:
+        return AnalyzerClient(server_socket,
+                              analyzer_kwargs["analyzer"],
+                              mecab_dic_dir=analyzer_kwargs["mecab_dic_dir"],
+                              h2z=analyzer_kwargs["h2z"],
+                              record_latencies=analyzer_kwargs.get("record_latencies", False))
+    return MorphologicalAnalyzer(**analyzer_kwargs)
+
+
+# one analyzer instance per worker process
+worker_morphological_analyzer = None
+
+
+def init_worker(analyzer_kwargs, server_socket):
+    global worker_morphological_analyzer
+    worker_morphological_analyzer = get_morphological_analyzer(analyzer_kwargs, server_socket)
+
+
+def process_batch_in_worker(batch, process_func, column_names):
+    outputs, messages, stats = process_func(batch, worker_morphological_analyzer, column_names)
+    worker_morphological_analyzer.flush_cache()
+    stats.update(worker_morphological_analyzer.pop_cache_stats())
+    return outputs, messages, stats
+
+
+def get_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def process_batches(items, process_func, args, analyzer_kwargs, server_socket=None):
+    batches = get_batches(items, args.batch_size)
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers, initializer=init_worker,
+                                  initargs=(analyzer_kwargs, server_socket)) as pool:
+            # results come back in the original order
+            yield from imap_bounded(pool,
+                                    functools.partial(process_batch_in_worker,
+                                                      process_func=process_func,
+                                                      column_names=args.column_names),
+                                    batches, args.workers * 2)
+    else:
+        morphological_analyzer = get_morphological_analyzer(analyzer_kwargs, server_socket)
+        for batch in batches:
+            outputs, messages, stats = process_func(batch, morphological_analyzer, args.column_names)
+            stats.update(morphological_analyzer.pop_cache_stats())
+            yield outputs, messages, stats
+        morphological_analyzer.close()
+
+
+def print_cache_report(args, cache_stats):
+    from tokenization_cache import TokenizationCache, print_cache_report
+    cache = TokenizationCache(args.cache_file, "")
+    entry_num, file_size = cache.get_size()
+    cache.close()
+    print_cache_report(cache_stats, entry_num, file_size)
+
+
+def process_results(results, instrumentation):
+    for outputs, messages, stats in results:
+        instrumentation.update(stats)
+        instrumentation.count("lines_skipped", len(messages))
+        instrumentation.maybe_print_progress()
+        for message in messages:
+            print(message, file=sys.stderr)
+        yield outputs
+
+
+def main(args):
+    analyzer_kwargs = dict(analyzer=args.morphological_analyzer,
+                           mecab_dic_dir=args.mecab_dic_dir,
+                           h2z=args.h2z,
+                           cache_file=args.cache_file,
+                           cache_lru_size=args.cache_lru_size,
+                           timeout=args.analyzer_timeout,
+                           record_latencies=True)
+    instrumentation = Instrumentation("apply_morphological_analysis", progress_interval=args.progress_interval,
+                                      report_file=args.report_file, profile_dir=args.profile_dir)
+    if args.shard_size is not None:
+        # only json lines are sharded, since a csv row or a squad json is not a line
+        if args.input_file_type != "json":
+            raise ValueError("--shard-size is only for json")
+        if args.sharded_output_file is None:
+            raise ValueError("--shard-size needs --sharded-output-file")
+        out_file = ShardedWriter(args.sharded_output_file, shard_size=args.shard_size, compression=args.shard_compression)
+    else:
+        out_file = CountingWriter(sys.stdout)
+
+    server_socket = None
+    if args.server_socket is not None:
+        # the socket may be left by a server that was killed
+        if is_server_running(args.server_socket):
+            server_socket = args.server_socket
+        else:
+            print(f"analyzer server not found at {args.server_socket}: analyzing in this process", file=sys.stderr)
+    get_results = functools.partial(process_batches, args=args, analyzer_kwargs=analyzer_kwargs,
+                                    server_socket=server_socket)
+
+    with instrumentation.stage(args.input_file_type):
+        if args.input_file_type == "json":
+            for outputs in process_results(get_results(sys.stdin, process_json_lines),
+                                           instrumentation):
+                for output in outputs:
+                    print(output, file=out_file)
+
+        elif args.input_file_type == "csv":
+            reader = csv.DictReader(sys.stdin)
+
+            writer = csv.writer(out_file)
+            writer.writerow(reader.fieldnames)
+            for outputs in process_results(get_results(reader, process_csv_rows),
+                                           instrumentation):
+                writer.writerows(outputs)
+
+        elif args.input_file_type == "squad_json":
+            checkpoint = None
+            if args.checkpoint_file is not None:
+                checkpoint = SquadCheckpoint(args.checkpoint_file)
+                if len(checkpoint.finished) > 0:
+                    print(f"resuming from {args.checkpoint_file}: {len(checkpoint.finished)} articles", file=sys.stderr)
+            # articles are read, processed and written one batch at a time
+            items = get_squad_items(SquadArticleReader(sys.stdin), checkpoint)
+            with SquadArticleWriter(out_file) as writer:
+                for outputs in process_results(get_results(items, process_squad_articles), instrumentation):
+                    write_squad_outputs(outputs, writer, checkpoint, instrumentation)
+            if checkpoint is not None:
+                # the run is complete
+                checkpoint.close(remove=True)
+            print_unaligned_answer_report(instrumentation.stats)
+
+    if args.checkpoint_file is not None and args.input_file_type != "squad_json":
+        print("--checkpoint-file is only for squad_json: ignored", file=sys.stderr)
+
+    if args.cache_file is not None:
+        print_cache_report(args, instrumentation.stats)
+
+    if args.shard_size is not None:
+        out_file.close()
+    instrumentation.count("bytes_written", out_file.bytes_written)
+    instrumentation.report()
 
 
 if __name__ == "__main__":
@@ -130,5 +402,58 @@ if __name__ == "__main__":
                         action='store_true',
                         default=False,
                         help="hankaku to zenkaku")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="number of worker processes, each of which has its own analyzer")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=100,
+                        help="number of lines (articles for squad_json) sent to the analyzer at once")
+    parser.add_argument("--cache-file",
+                        type=str,
+                        default=None,
+                        help="sqlite file for caching tokenized strings (shared across datasets and runs)")
+    parser.add_argument("--cache-lru-size",
+                        type=int,
+                        default=100000,
+                        help="number of tokenized strings kept in memory in front of the cache file")
+    parser.add_argument("--server-socket",
+                        type=str,
+                        default=None,
+                        help="socket of analyzer_server.py: the strings are analyzed by the server if it is running")
+    parser.add_argument("--analyzer-timeout",
+                        type=int,
+                        default=30,
+                        help="seconds per call to juman/jumanpp, after which the process is restarted (default: 30)")
+    parser.add_argument("--checkpoint-file",
+                        type=str,
+                        default=None,
+                        help="log of the processed articles for resuming an interrupted run (squad_json only); "
+                             "removed when the run completes")
+    parser.add_argument("--shard-size",
+                        type=int,
+                        default=None,
+                        help="write compressed shards of N lines and an index instead of stdout (json only)")
+    parser.add_argument("--shard-compression",
+                        choices=["gzip", "zstd"],
+                        default="gzip",
+                        help="compression of the shards")
+    parser.add_argument("--sharded-output-file",
+                        type=str,
+                        default=None,
+                        help="output path: the shards are written to this path + .gz/.zst and their index to this path + .index.json")
+    parser.add_argument("--progress-interval",
+                        type=float,
+                        default=None,
+                        help="print a progress line to stderr every N seconds")
+    parser.add_argument("--report-file",
+                        type=str,
+                        default=None,
+                        help="write the final counters/timers report as json")
+    parser.add_argument("--profile-dir",
+                        type=str,
+                        default=None,
+                        help="write cProfile output of each stage under this dir (main process only)")
     args = parser.parse_args()
     main(args)
@@ -4,9 +4,83 @@ import sys
 import argparse
 import json
 import subprocess
+import hashlib
+import functools
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common", "scripts"))
+from instrumentation import Instrumentation, observe_latency
+from sharded_output import get_index_path
 
-def main(args):
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# every file that a job runs, including the modules imported by apply_morphological_analysis.py
+SCRIPT_FILES = ["Makefile", "apply_morphological_analysis.py", "morphological_analyzer.py", "squad_json.py",
+                "tokenization_cache.py", "analyzer_server.py",
+                "../../common/scripts/instrumentation.py", "../../common/scripts/sharded_output.py",
+                "../../common/scripts/parallel.py"]
+
+TARGET_TO_BASENAME_KEY = {"out_train_file": "train_file_basename",
+                          "out_valid_file": "valid_file_basename",
+                          "out_test_file": "test_file_basename"}
+
+ANALYZER_VERSION_COMMANDS = {"jumanpp": "jumanpp -v",
+                             "juman": "juman -v",
+                             "mecab": "mecab -v"}
+
+
+def get_file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_analyzer_version(morphological_analyzer):
+    if morphological_analyzer not in ANALYZER_VERSION_COMMANDS:
+        return morphological_analyzer
+    completed = subprocess.run(ANALYZER_VERSION_COMMANDS[morphological_analyzer], shell=True,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return completed.stdout.decode("utf-8", errors="replace").strip()
+
+
+# a job is rerun when any of its input file, dataset config, options, analyzer version or scripts changes
+def get_job_hash(job, args):
+    script_hashes = [get_file_hash(os.path.join(SCRIPT_DIR, script_file)) for script_file in SCRIPT_FILES]
+    key = json.dumps({"input": get_file_hash(job["input_file"]),
+                      "dataset": job["dataset"],
+                      "morphological_analyzer": job["morphological_analyzer"],
+                      "analyzer_version": get_analyzer_version(job["morphological_analyzer"]),
+                      "h2z": args.h2z,
+                      "mecab_dic_dir": args.mecab_dic_dir,
+                      "shard_size": args.shard_size,
+                      "shard_compression": args.shard_compression,
+                      "scripts": script_hashes},
+                     sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def load_manifest(manifest_file):
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest, manifest_file):
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def get_jobs(args):
+    jobs = []
     datasets = json.load(open(args.datasets_json))
     for dataset in datasets:
         input_dir = f"{args.data_dir}/{dataset['dirname']}"
@@ -14,30 +88,162 @@ def main(args):
             output_dir = f"{args.data_dir}/{dataset['dirname']}_{morphological_analyzer}"
 
             target = dataset["target"] if "target" in dataset else "out_train_file out_valid_file out_test_file"
-            cmds = ["make", target,
-                    "-f", "Makefile",
-                    "INPUT_DIR={}".format(input_dir),
-                    "OUTPUT_DIR={}".format(output_dir),
-                    "TRAIN_FILE_BASENAME={}".format(dataset["train_file_basename"]),
-                    "VALID_FILE_BASENAME={}".format(dataset["valid_file_basename"]),
-                    "TEST_FILE_BASENAME={}".format(dataset["test_file_basename"]),
-                    "MORPHOLOGICAL_ANALYZER={}".format(morphological_analyzer),
-                    "INPUT_FILE_TYPE={}".format(dataset["input-file-type"])]
-            if "column-names" in dataset:
-                cmds.append("COLUMN_NAMES=\"{}\"".format(dataset["column-names"]))
-            if "test_file_basename" in dataset:
-                cmds.append("TEST_FILE_BASENAME={}".format(dataset["test_file_basename"]))
-            if args.h2z is True:
-                cmds.append("H2Z=1")
-            if "mecab" in morphological_analyzer and args.mecab_dic_dir is not None:
-                cmds.append("MECAB_DIC_DIR={}".format(args.mecab_dic_dir))
-
-            if args.dry_run is True:
-                cmds.insert(1, "-n")
-
-            cmd = ' '.join(cmds)
-            completed = subprocess.run(cmd, shell=True)
-            print(completed, file=sys.stderr)
+            # one job per split, so that the splits are also run concurrently
+            for split_target in target.split():
+                cmds = ["make", split_target,
+                        "-f", "Makefile",
+                        "INPUT_DIR={}".format(input_dir),
+                        "OUTPUT_DIR={}".format(output_dir),
+                        "TRAIN_FILE_BASENAME={}".format(dataset["train_file_basename"]),
+                        "VALID_FILE_BASENAME={}".format(dataset["valid_file_basename"]),
+                        "TEST_FILE_BASENAME={}".format(dataset["test_file_basename"]),
+                        "MORPHOLOGICAL_ANALYZER={}".format(morphological_analyzer),
+                        "INPUT_FILE_TYPE={}".format(dataset["input-file-type"])]
+                if "column-names" in dataset:
+                    cmds.append("COLUMN_NAMES=\"{}\"".format(dataset["column-names"]))
+                if "test_file_basename" in dataset:
+                    cmds.append("TEST_FILE_BASENAME={}".format(dataset["test_file_basename"]))
+                if args.h2z is True:
+                    cmds.append("H2Z=1")
+                if "mecab" in morphological_analyzer and args.mecab_dic_dir is not None:
+                    cmds.append("MECAB_DIC_DIR={}".format(args.mecab_dic_dir))
+                if args.workers is not None:
+                    cmds.append("WORKERS={}".format(args.workers))
+                if args.batch_size is not None:
+                    cmds.append("BATCH_SIZE={}".format(args.batch_size))
+                if args.cache_file is not None:
+                    cmds.append("CACHE_FILE={}".format(os.path.abspath(args.cache_file)))
+                if args.server_socket is not None:
+                    cmds.append("SERVER_SOCKET={}".format(os.path.abspath(args.server_socket)))
+                if args.analyzer_timeout is not None:
+                    cmds.append("ANALYZER_TIMEOUT={}".format(args.analyzer_timeout))
+                if args.checkpoint is True and dataset["input-file-type"] == "squad_json":
+                    cmds.append("CHECKPOINT=1")
+                if args.shard_size is not None and dataset["input-file-type"] == "json":
+                    cmds.append("SHARD_SIZE={}".format(args.shard_size))
+                    cmds.append("SHARD_COMPRESSION={}".format(args.shard_compression))
+                if args.progress_interval is not None:
+                    cmds.append("PROGRESS_INTERVAL={}".format(args.progress_interval))
+                if args.profile_dir is not None:
+                    cmds.append("PROFILE_DIR={}".format(os.path.abspath(args.profile_dir)))
+
+                name = f"{dataset['dirname']}_{morphological_analyzer}:{split_target}"
+                report_file = None
+                if args.report_dir is not None:
+                    report_file = os.path.join(os.path.abspath(args.report_dir), name.replace(":", ".") + ".json")
+                    cmds.append("REPORT_FILE={}".format(report_file))
+
+                if args.dry_run is True:
+                    cmds.insert(1, "-n")
+                else:
+                    # whether to run is decided by the manifest, not by the mtimes
+                    cmds.insert(1, "-B")
+
+                input_file, output_file = None, None
+                if split_target in TARGET_TO_BASENAME_KEY:
+                    basename = dataset[TARGET_TO_BASENAME_KEY[split_target]]
+                    input_file = f"{input_dir}/{basename}"
+                    output_file = f"{output_dir}/{basename}"
+                    if args.shard_size is not None and dataset["input-file-type"] == "json":
+                        output_file = get_index_path(output_file)
+
+                jobs.append(dict(name=name,
+                                 cmd=" ".join(cmds),
+                                 report_file=report_file,
+                                 dataset=dataset,
+                                 morphological_analyzer=morphological_analyzer,
+                                 input_file=input_file,
+                                 output_file=output_file))
+    return jobs
+
+
+def run_job(job, args, manifest, manifest_lock):
+    result = dict(name=job["name"], status="done", elapsed=0.0, lines=0, bytes=0, counters={})
+
+    job_hash = None
+    if job["input_file"] is not None and os.path.exists(job["input_file"]):
+        job_hash = get_job_hash(job, args)
+        with open(job["input_file"], "rb") as f:
+            result["lines"] = sum(1 for _ in f)
+        result["bytes"] = os.path.getsize(job["input_file"])
+
+        if args.force is False and args.dry_run is False and os.path.exists(job["output_file"]):
+            with manifest_lock:
+                if manifest.get(job["output_file"]) == job_hash:
+                    result["status"] = "skipped"
+                    return result
+
+    # the output is overwritten (or truncated by a failing run) from here on, so it is not up to date
+    # until the job completes
+    if args.dry_run is False and job["output_file"] is not None:
+        with manifest_lock:
+            if manifest.pop(job["output_file"], None) is not None:
+                save_manifest(manifest, args.manifest_file)
+
+    start_time = time.time()
+    completed = subprocess.run(job["cmd"], shell=True)
+    result["elapsed"] = time.time() - start_time
+    print(completed, file=sys.stderr)
+
+    if completed.returncode != 0:
+        result["status"] = "failed"
+    elif args.dry_run is False and job_hash is not None:
+        with manifest_lock:
+            manifest[job["output_file"]] = job_hash
+            save_manifest(manifest, args.manifest_file)
+
+    if completed.returncode == 0 and job["report_file"] is not None and os.path.exists(job["report_file"]):
+        with open(job["report_file"], "r") as f:
+            result["counters"] = json.load(f)["counters"]
+
+    return result
+
+
+def print_summary(results, total_elapsed):
+    print("job\tstatus\tsec\tlines\tlines/s\tMB/s", file=sys.stderr)
+    for result in results:
+        lines_per_sec, mb_per_sec = "-", "-"
+        if result["status"] == "done" and result["elapsed"] > 0:
+            lines_per_sec = "{:.1f}".format(result["lines"] / result["elapsed"])
+            mb_per_sec = "{:.3f}".format(result["bytes"] / result["elapsed"] / 1e6)
+        print("{}\t{}\t{:.2f}\t{}\t{}\t{}".format(result["name"], result["status"], result["elapsed"],
+                                                 result["lines"], lines_per_sec, mb_per_sec), file=sys.stderr)
+    status_counts = Counter(result["status"] for result in results)
+    print("total: {:.2f} sec, {}".format(total_elapsed,
+                                         ", ".join(f"{count} {status}" for status, count in sorted(status_counts.items()))),
+          file=sys.stderr)
+
+
+def main(args):
+    if args.manifest_file is None:
+        args.manifest_file = os.path.join(args.data_dir, ".morphological_analysis_manifest.json")
+    manifest = load_manifest(args.manifest_file)
+    manifest_lock = threading.Lock()
+
+    report_file = None
+    if args.report_dir is not None:
+        os.makedirs(args.report_dir, exist_ok=True)
+        report_file = os.path.join(args.report_dir, "apply_morphological_analysis_all.json")
+    instrumentation = Instrumentation("apply_morphological_analysis_all", report_file=report_file,
+                                      profile_dir=args.profile_dir)
+
+    jobs = get_jobs(args)
+
+    start_time = time.time()
+    results = []
+    with instrumentation.stage("jobs"):
+        # each job is a separate make process, so threads are enough to run them concurrently
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            for result in executor.map(lambda job: run_job(job, args, manifest, manifest_lock), jobs):
+                results.append(result)
+                instrumentation.count(f"jobs_{result['status']}")
+                if result["status"] != "skipped":
+                    observe_latency(instrumentation.stats, "job", result["elapsed"])
+                # the counters of the jobs are summed up
+                instrumentation.update(result["counters"])
+
+    print_summary(results, time.time() - start_time)
+    instrumentation.report()
 
 
 if __name__ == "__main__":
@@ -68,5 +274,62 @@ if __name__ == "__main__":
                         action='store_true',
                         default=False,
                         help="hankaku to zenkaku")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="number of worker processes per dataset")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=None,
+                        help="number of lines sent to the analyzer at once")
+    parser.add_argument("--cache-file",
+                        type=str,
+                        default=None,
+                        help="sqlite file for caching tokenized strings (shared across datasets and runs)")
+    parser.add_argument("--server-socket",
+                        type=str,
+                        default=None,
+                        help="socket of analyzer_server.py: the jobs share its warm analyzers if it is running")
+    parser.add_argument("--analyzer-timeout",
+                        type=int,
+                        default=None,
+                        help="seconds per call to juman/jumanpp, after which the process is restarted (default: 30)")
+    parser.add_argument("--checkpoint",
+                        action='store_true',
+                        default=False,
+                        help="keep a checkpoint of the processed articles next to each squad_json output, "
+                             "so that an interrupted job resumes where it stopped")
+    parser.add_argument("--shard-size",
+                        type=int,
+                        default=None,
+                        help="write each json lines output as compressed shards of N lines and an index")
+    parser.add_argument("--shard-compression",
+                        choices=["gzip", "zstd"],
+                        default="gzip",
+                        help="compression of the shards")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=1,
+                        help="number of (dataset, analyzer, split) jobs run concurrently")
+    parser.add_argument("--manifest-file",
+                        type=str,
+                        default=None,
+                        help="manifest of the content hashes of finished jobs (default: DATA_DIR/.morphological_analysis_manifest.json)")
+    parser.add_argument("--force",
+                        action='store_true',
+                        default=False,
+                        help="rerun all the jobs even if their inputs are unchanged")
+    parser.add_argument("--progress-interval",
+                        type=float,
+                        default=None,
+                        help="print a progress line of each job to stderr every N seconds")
+    parser.add_argument("--report-dir",
+                        type=str,
+                        default=None,
+                        help="write a json report of each job and of all the jobs under this dir")
+    parser.add_argument("--profile-dir",
+                        type=str,
+                        default=None,
+                        help="write cProfile output of each stage of each job under this dir")
     args = parser.parse_args()
     main(args)
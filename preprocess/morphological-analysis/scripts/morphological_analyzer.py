@@ -1,10 +1,15 @@
 import os
 import sys
+import time
+import subprocess
+from collections import Counter
 
 import zenhan
 
 
 class Word(object):
+    __slots__ = ("string", "pos", "start_position", "end_position")
+
     def __init__(self, string, pos=None, offset=0):
         self.string = string
         self.pos = pos
@@ -15,19 +20,54 @@ class Word(object):
 class MorphologicalAnalyzer(object):
     def __init__(self, analyzer,
                  mecab_dic_dir=None,
-                 h2z=False):
+                 h2z=False,
+                 cache_file=None,
+                 cache_lru_size=100000,
+                 timeout=30,
+                 record_latencies=False):
         self._analyzer = analyzer
         self._h2z = h2z
+        # seconds per call to juman/jumanpp
+        self._timeout = timeout
+        # seconds of each string analyzed (not found in the cache), until pop_latencies() is called
+        self._latencies = [] if record_latencies is True else None
+
+        self._cache = None
+        if cache_file is not None:
+            from tokenization_cache import TokenizationCache
+            namespace = "\t".join([analyzer,
+                                   os.path.abspath(mecab_dic_dir) if mecab_dic_dir is not None else "",
+                                   str(h2z)])
+            self._cache = TokenizationCache(cache_file, namespace, lru_size=cache_lru_size)
 
         if self._analyzer == "jumanpp" or self._analyzer == "juman":
-            from pyknp import Juman
-            self._juman = Juman(jumanpp=True if self._analyzer == "jumanpp" else False)
+            self._init_juman()
         elif self._analyzer == "mecab":
             import MeCab
             tagger_option_string = ""
             if mecab_dic_dir is not None:
                 tagger_option_string += f" -d {mecab_dic_dir}"
             self._mecab = MeCab.Tagger(tagger_option_string)
+            # for get_surfaces, which does not need a node per word
+            self._mecab_wakati = MeCab.Tagger(tagger_option_string + " -Owakati")
+
+    def _init_juman(self):
+        from pyknp import Juman
+        self._juman = Juman(jumanpp=True if self._analyzer == "jumanpp" else False, timeout=self._timeout)
+
+    # a juman/jumanpp process that timed out is killed and a new one is started,
+    # since its output for the string may still come after the timeout
+    def _juman_analysis(self, string):
+        for _ in range(2):
+            try:
+                return self._juman.analysis(string)
+            except subprocess.TimeoutExpired:
+                print(f"{self._analyzer} timed out: restarting. sentence: {string}", file=sys.stderr)
+                juman_subprocess = self._juman.analyzer.subprocess
+                if juman_subprocess is not None:
+                    juman_subprocess.process.kill()
+                self._init_juman()
+        raise ValueError(f"{self._analyzer} timed out twice")
 
     def get_words(self, string):
         words = []
@@ -35,7 +75,7 @@ class MorphologicalAnalyzer(object):
 
         if self._analyzer == "jumanpp" or self._analyzer == "juman":
             try:
-                result = self._juman.analysis(string)
+                result = self._juman_analysis(string)
             except ValueError as e:
                 print(f"{e}. skip sentence: {string}", file=sys.stderr)
                 return []
@@ -44,12 +84,11 @@ class MorphologicalAnalyzer(object):
                 words.append(Word(mrph.midasi, pos=mrph.hinsi, offset=offset))
                 offset += len(mrph.midasi)
         elif self._analyzer == "mecab":
-            self._mecab.parse("")
             node = self._mecab.parseToNode(string)
             while node:
                 word = node.surface
-                pos = node.feature.split(",")[0]
-                if node.feature.split(",")[0] != "BOS/EOS":
+                pos = node.feature.split(",", 1)[0]
+                if pos != "BOS/EOS":
                     words.append(Word(word, pos=pos, offset=offset))
                     offset += len(word)
                 node = node.next
@@ -62,12 +101,77 @@ class MorphologicalAnalyzer(object):
 
         return words
 
-    def get_tokenized_string(self, string):
+    # surface strings only, without creating a Word per token
+    def get_surfaces(self, string):
+        if self._analyzer == "jumanpp" or self._analyzer == "juman":
+            try:
+                result = self._juman_analysis(string)
+            except ValueError as e:
+                print(f"{e}. skip sentence: {string}", file=sys.stderr)
+                return []
+
+            return [mrph.midasi for mrph in result.mrph_list()]
+        elif self._analyzer == "mecab":
+            # wakati output is "surface surface ... \n"
+            surfaces = self._mecab_wakati.parse(string).rstrip("\n").split(" ")
+            if surfaces[-1] == "":
+                surfaces.pop()
+            return surfaces
+        elif self._analyzer == "char":
+            return list(string)
+        else:
+            return [word.string for word in self.get_words(string)]
+
+    def _get_tokenized_string(self, string):
+        start_time = time.perf_counter()
         if self._h2z is True:
             string = zenhan.h2z(string)
 
-        words = self.get_words(string)
-        if len(words) > 0:
-            return " ".join([word.string for word in words])
+        surfaces = self.get_surfaces(string)
+        if self._latencies is not None:
+            self._latencies.append(time.perf_counter() - start_time)
+        if len(surfaces) > 0:
+            return " ".join(surfaces)
         else:
             return None
+
+    def get_tokenized_string(self, string):
+        if self._cache is None:
+            return self._get_tokenized_string(string)
+        return self.get_tokenized_strings([string])[0]
+
+    def get_tokenized_strings(self, strings):
+        if self._cache is None:
+            return [self._get_tokenized_string(string) for string in strings]
+
+        tokenized_strings = self._cache.get_many(set(strings))
+        for string in strings:
+            if string not in tokenized_strings:
+                tokenized_string = self._get_tokenized_string(string)
+                tokenized_strings[string] = tokenized_string
+                # parse errors are not cached
+                if tokenized_string is not None:
+                    self._cache.put(string, tokenized_string)
+        return [tokenized_strings[string] for string in strings]
+
+    def pop_latencies(self):
+        if self._latencies is None:
+            return []
+        latencies = self._latencies
+        self._latencies = []
+        return latencies
+
+    def pop_cache_stats(self):
+        if self._cache is None:
+            return Counter()
+        stats = self._cache.stats
+        self._cache.stats = Counter()
+        return stats
+
+    def flush_cache(self):
+        if self._cache is not None:
+            self._cache.flush()
+
+    def close(self):
+        if self._cache is not None:
+            self._cache.close()
@@ -0,0 +1,151 @@
+import os
+import re
+import json
+
+
+WHITESPACE = re.compile(r"\s*")
+DELIMITERS = set(" \t\n\r,:]}")
+
+
+# reads the articles of a SQuAD-format json ({"data": [article, ...], ...}) one by one,
+# so that the whole document does not have to be kept in memory
+class SquadArticleReader(object):
+    def __init__(self, f, chunk_size=1 << 20):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        chunk = self._f.read(self._chunk_size)
+        if chunk == "":
+            self._eof = True
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or self._eof is True:
+                return
+            self._fill()
+
+    def _next_char(self):
+        self._skip_whitespace()
+        if self._pos >= len(self._buffer):
+            raise ValueError("unexpected end of squad json")
+        ch = self._buffer[self._pos]
+        self._pos += 1
+        return ch
+
+    def _expect(self, expected):
+        ch = self._next_char()
+        if ch != expected:
+            raise ValueError(f"expected {expected!r} but found {ch!r} in squad json")
+
+    def _decode(self):
+        while True:
+            self._skip_whitespace()
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # a number cut at the end of the buffer (e.g. "1." of "1.25") may continue in the next chunk
+                if self._eof is True or (end < len(self._buffer) and self._buffer[end] in DELIMITERS):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof is True:
+                    raise
+            self._fill()
+
+    def __iter__(self):
+        self._expect("{")
+        self._skip_whitespace()
+        if self._buffer[self._pos:self._pos + 1] == "}":
+            return
+
+        while True:
+            key = self._decode()
+            self._expect(":")
+            if key == "data":
+                self._expect("[")
+                self._skip_whitespace()
+                if self._buffer[self._pos:self._pos + 1] == "]":
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._decode()
+                        ch = self._next_char()
+                        if ch == "]":
+                            break
+                        elif ch != ",":
+                            raise ValueError(f"expected ',' or ']' but found {ch!r} in squad json")
+            else:
+                # other keys such as "version" are dropped
+                self._decode()
+
+            ch = self._next_char()
+            if ch == "}":
+                break
+            elif ch != ",":
+                raise ValueError(f"expected ',' or '}}' but found {ch!r} in squad json")
+
+
+# writes {"data": [article, ...]} in the same format as json.dumps({"data": data}, ensure_ascii=False)
+class SquadArticleWriter(object):
+    def __init__(self, f):
+        self._f = f
+        self._article_num = 0
+
+    def __enter__(self):
+        self._f.write('{"data": [')
+        return self
+
+    def write(self, article_string):
+        if self._article_num > 0:
+            self._f.write(", ")
+        self._f.write(article_string)
+        self._article_num += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._f.write("]}\n")
+
+
+# an append-only log of the processed articles, so that an interrupted run can be resumed
+# each line is {"index": ..., "title": (original title), "article": (output string), "stats": {...}}
+class SquadCheckpoint(object):
+    def __init__(self, path):
+        self.path = path
+        self.finished = {}
+
+        valid_size = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("incomplete line")
+                        entry = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        # the last line may have been cut by the interruption
+                        break
+                    self.finished[entry["index"]] = entry
+                    valid_size += len(line)
+        self._f = open(path, "ab")
+        self._f.truncate(valid_size)
+
+    def append(self, index, title, article_string, stats):
+        entry = dict(index=index, title=title, article=article_string, stats=stats)
+        self._f.write(json.dumps(entry, ensure_ascii=False).encode("utf-8") + b"\n")
+
+    # called once per batch
+    def flush(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self, remove=False):
+        self._f.close()
+        if remove is True:
+            os.remove(self.path)
@@ -0,0 +1,95 @@
+import os
+import sys
+import hashlib
+import sqlite3
+from collections import OrderedDict, Counter
+
+
+# on-disk cache of tokenized strings with an in-process LRU in front of it
+# keys are hashes of (analyzer, dic dir, h2z flag) and an input string, so the same file can be shared
+# across datasets, analyzers and runs
+class TokenizationCache(object):
+    def __init__(self, cache_file, namespace, lru_size=100000, commit_interval=1000):
+        self._cache_file = cache_file
+        self._namespace = namespace
+        self._lru_size = lru_size
+        self._commit_interval = commit_interval
+
+        self._lru = OrderedDict()
+        # (key, value) pairs not written yet: they are written at once in flush(), so that no write transaction
+        # (and so no lock of the file) is held while the analyzer runs, and processes sharing the file do not wait
+        self._pending = []
+        self.stats = Counter()
+
+        self._connection = sqlite3.connect(cache_file, timeout=600)
+        # WAL allows the worker processes to read while another one is writing
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS tokenization (key BLOB PRIMARY KEY, value TEXT)")
+        self._connection.commit()
+
+    def _get_key(self, string):
+        return hashlib.sha1(f"{self._namespace}\0{string}".encode("utf-8")).digest()
+
+    def _add_to_lru(self, key, value):
+        self._lru[key] = value
+        if len(self._lru) > self._lru_size:
+            self._lru.popitem(last=False)
+
+    def get_many(self, strings):
+        results = {}
+        missing_keys = {}
+        for string in strings:
+            key = self._get_key(string)
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                results[string] = self._lru[key]
+                self.stats["lru_hits"] += 1
+            else:
+                missing_keys[key] = string
+
+        keys = list(missing_keys.keys())
+        disk_hit_num = 0
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            query = "SELECT key, value FROM tokenization WHERE key IN ({})".format(",".join("?" * len(chunk)))
+            for key, value in self._connection.execute(query, chunk):
+                results[missing_keys[key]] = value
+                self._add_to_lru(key, value)
+                disk_hit_num += 1
+
+        self.stats["disk_hits"] += disk_hit_num
+        self.stats["misses"] += len(missing_keys) - disk_hit_num
+        return results
+
+    def put(self, string, value):
+        key = self._get_key(string)
+        self._add_to_lru(key, value)
+        self._pending.append((key, value))
+        if len(self._pending) >= self._commit_interval:
+            self.flush()
+
+    def flush(self):
+        if len(self._pending) > 0:
+            with self._connection:
+                self._connection.executemany("INSERT OR REPLACE INTO tokenization (key, value) VALUES (?, ?)",
+                                             self._pending)
+            self._pending = []
+
+    def get_size(self):
+        entry_num = self._connection.execute("SELECT COUNT(*) FROM tokenization").fetchone()[0]
+        file_size = sum(os.path.getsize(path) for path in (self._cache_file, self._cache_file + "-wal")
+                        if os.path.exists(path))
+        return entry_num, file_size
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+
+
+def print_cache_report(stats, entry_num, file_size, file=sys.stderr):
+    hit_num = stats["lru_hits"] + stats["disk_hits"]
+    lookup_num = hit_num + stats["misses"]
+    hit_rate = hit_num / lookup_num if lookup_num > 0 else 0.0
+    print(f"tokenization cache: {lookup_num} lookups, hit rate {hit_rate:.3f} "
+          f"(lru {stats['lru_hits']}, disk {stats['disk_hits']}), "
+          f"{entry_num} entries, {file_size} bytes", file=file)
@@ -0,0 +1,42 @@
+import os
+import sys
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from tokenization_cache import TokenizationCache
+
+
+def put_and_wait(cache_file, first_put, second_flushed):
+    cache = TokenizationCache(cache_file, "mecab")
+    cache.put("東京都", "東京 都")
+    first_put.set()
+    # keeps the put pending, as a worker does while it analyzes the rest of its batch
+    second_flushed.wait(10)
+    cache.close()
+
+
+def test_processes_sharing_cache_file(tmp_path):
+    cache_file = str(tmp_path / "cache.sqlite")
+    context = multiprocessing.get_context("fork")
+    first_put, second_flushed = context.Event(), context.Event()
+    process = context.Process(target=put_and_wait, args=(cache_file, first_put, second_flushed))
+    process.start()
+    assert first_put.wait(10)
+
+    # the other process does not hold the lock of the file, so this does not wait for it
+    start_time = time.perf_counter()
+    cache = TokenizationCache(cache_file, "mecab")
+    cache.put("京都府", "京都 府")
+    cache.flush()
+    elapsed = time.perf_counter() - start_time
+    second_flushed.set()
+    process.join(10)
+    assert process.exitcode == 0
+    assert elapsed < 5
+
+    cache = TokenizationCache(cache_file, "mecab")
+    assert cache.get_many(["東京都", "京都府", "大阪府"]) == {"東京都": "東京 都", "京都府": "京都 府"}
+    assert cache.stats["disk_hits"] == 2 and cache.stats["misses"] == 1
+    assert cache.get_size()[0] == 2
+    cache.close()
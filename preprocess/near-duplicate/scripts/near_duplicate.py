@@ -0,0 +1,323 @@
+import os
+import io
+import sys
+import argparse
+import json
+import re
+import unicodedata
+import itertools
+import multiprocessing
+from collections import Counter, defaultdict
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common", "scripts"))
+from instrumentation import Instrumentation
+
+SPLIT_TO_BASENAME_KEY = {"train": "train_file_basename",
+                         "valid": "valid_file_basename",
+                         "test": "test_file_basename"}
+WHITESPACE = re.compile(r"\s+")
+# for the rolling hash of the character n-grams
+NGRAM_BASE = np.uint64(1000003)
+
+
+class Document(object):
+    __slots__ = ("dataset", "split", "index", "column", "text")
+
+    def __init__(self, dataset, split, index, column, text):
+        self.dataset = dataset
+        self.split = split
+        self.index = index
+        self.column = column
+        self.text = text
+
+    def to_dict(self):
+        return dict(dataset=self.dataset, split=self.split, index=self.index, column=self.column, text=self.text)
+
+
+# a document per record (the columns joined), or a document per column with unit == "column"
+# for squad_json, a document per paragraph context
+def read_documents(input_file, dataset, split, column_names, input_file_type, unit):
+    with open(input_file, "r", encoding="utf-8") as f:
+        if input_file_type == "squad_json":
+            data = json.load(f)["data"]
+            contexts = (paragraph["context"] for article in data for paragraph in article["paragraphs"])
+            for idx, context in enumerate(contexts):
+                yield Document(dataset, split, idx, "context", context)
+        else:
+            for idx, line in enumerate(f):
+                record = json.loads(line)
+                if unit == "column":
+                    for column_name in column_names:
+                        yield Document(dataset, split, idx, column_name, record[column_name])
+                else:
+                    yield Document(dataset, split, idx, None, "\n".join(record[column_name] for column_name in column_names))
+
+
+def read_all_documents(args):
+    datasets = json.load(open(args.datasets_json))
+    for dataset in datasets:
+        if args.datasets is not None and dataset["dirname"] not in args.datasets:
+            continue
+        column_names = dataset.get("column-names", "").split()
+        for split, basename_key in SPLIT_TO_BASENAME_KEY.items():
+            input_file = os.path.join(args.data_dir, dataset["dirname"], dataset[basename_key])
+            if not os.path.exists(input_file):
+                continue
+            yield from read_documents(input_file, dataset["dirname"], split, column_names,
+                                      dataset["input-file-type"], args.unit)
+
+
+# width, case and whitespace (e.g. the spaces inserted by the morphological analysis) are ignored
+def normalize(text):
+    return WHITESPACE.sub("", unicodedata.normalize("NFKC", text).lower())
+
+
+# distinct 64-bit hashes of the character n-grams (the whole text if it is shorter than n)
+def get_ngram_hashes(text, ngram):
+    code_points = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    n = min(ngram, len(code_points))
+    hashes = np.zeros(len(code_points) - n + 1, dtype=np.uint64)
+    for k in range(n):
+        hashes = hashes * NGRAM_BASE + code_points[k:len(code_points) - n + 1 + k]
+    return np.unique(hashes)
+
+
+# the permutations are multiply-shift hashes ((a * x + b) mod 2^64) >> 32 with odd a
+def get_permutations(num_perm, seed):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64)
+    return a[:, np.newaxis], b[:, np.newaxis]
+
+
+def get_signature(ngram_hashes, permutations):
+    a, b = permutations
+    return ((a * ngram_hashes[np.newaxis, :] + b) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+
+# parameters of the worker processes
+worker_config = None
+
+
+def init_worker(ngram, num_perm, seed):
+    global worker_config
+    worker_config = (ngram, get_permutations(num_perm, seed))
+
+
+def get_signatures(texts):
+    ngram, permutations = worker_config
+    signatures = np.zeros((len(texts), permutations[0].shape[0]), dtype=np.uint32)
+    for idx, text in enumerate(texts):
+        signatures[idx] = get_signature(get_ngram_hashes(text, ngram), permutations)
+    return signatures
+
+
+def get_batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def compute_signatures(texts, args, instrumentation):
+    init_args = (args.ngram, args.num_perm, args.seed)
+    batches = get_batches(texts, args.batch_size)
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=init_args)
+        # results come back in the original order
+        batch_signatures = pool.imap(get_signatures, batches)
+    else:
+        pool = None
+        init_worker(*init_args)
+        batch_signatures = map(get_signatures, batches)
+
+    signatures = np.zeros((len(texts), args.num_perm), dtype=np.uint32)
+    position = 0
+    for batch_signature in batch_signatures:
+        signatures[position:position + len(batch_signature)] = batch_signature
+        position += len(batch_signature)
+        instrumentation.count("documents_hashed", len(batch_signature))
+        instrumentation.maybe_print_progress()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return signatures
+
+
+class UnionFind(object):
+    def __init__(self, size):
+        self.parents = list(range(size))
+
+    def find(self, x):
+        root = x
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[x] != root:
+            self.parents[x], x = root, self.parents[x]
+        return root
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            self.parents[max(x, y)] = min(x, y)
+
+
+# near-duplicate pairs (i, j) of a bucket (indices into bucket), with the number of compared pairs
+# All the pairs of a bucket of up to max_pairwise_size members are compared. In a larger bucket, each member is
+# compared with the representatives (the first member of each cluster found so far in the bucket), which keeps
+# the comparisons near-linear but can miss a pair of non-representatives (e.g. B matched the representative A,
+# and C is a near-duplicate of B but not of A); such a pair is usually found in another band.
+def get_bucket_duplicates(bucket_signatures, threshold, max_pairwise_size):
+    if len(bucket_signatures) <= max_pairwise_size:
+        similarities = (bucket_signatures[:, np.newaxis, :] == bucket_signatures[np.newaxis, :, :]).mean(axis=2)
+        pairs = np.argwhere(np.triu(similarities >= threshold, k=1))
+        return [(int(i), int(j)) for i, j in pairs], len(bucket_signatures) * (len(bucket_signatures) - 1) // 2
+
+    pairs, compared_num = [], 0
+    representatives = [0]
+    for idx in range(1, len(bucket_signatures)):
+        similarities = (bucket_signatures[representatives] == bucket_signatures[idx]).mean(axis=1)
+        compared_num += len(representatives)
+        matched = np.flatnonzero(similarities >= threshold)
+        pairs.extend((representatives[i], idx) for i in matched)
+        if len(matched) == 0:
+            representatives.append(idx)
+    return pairs, compared_num
+
+
+# The signatures are cut into bands of rows, and documents that share a band fall into the same bucket,
+# whose members are compared by get_bucket_duplicates; the similarity is the fraction of equal minhash values.
+def find_duplicates(signatures, bands, threshold, instrumentation, max_pairwise_size=64):
+    union_find = UnionFind(len(signatures))
+    # a 64-bit key per (document, band)
+    banded_signatures = signatures.reshape(len(signatures), bands, -1).astype(np.uint64)
+    band_keys = np.zeros((len(signatures), bands), dtype=np.uint64)
+    for row in range(banded_signatures.shape[2]):
+        band_keys = band_keys * NGRAM_BASE + banded_signatures[:, :, row]
+
+    for band in range(bands):
+        keys = band_keys[:, band]
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1], True])
+        for start, end in zip(starts[:-1], starts[1:]):
+            if end - start < 2:
+                continue
+            bucket = order[start:end]
+            pairs, compared_num = get_bucket_duplicates(signatures[bucket], threshold, max_pairwise_size)
+            instrumentation.count("candidate_pairs", compared_num)
+            instrumentation.count("duplicate_pairs", len(pairs))
+            for i, j in pairs:
+                union_find.union(int(bucket[i]), int(bucket[j]))
+
+    clusters = defaultdict(list)
+    for idx in range(len(signatures)):
+        clusters[union_find.find(idx)].append(idx)
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+def get_split_name(document):
+    return f"{document.dataset}:{document.split}"
+
+
+def get_overlap_report(documents, clusters):
+    split_document_nums = Counter(get_split_name(document) for document in documents)
+    duplicate_nums, leaked_nums, overlap_nums = Counter(), Counter(), Counter()
+    for members in clusters:
+        split_names = sorted(set(get_split_name(documents[idx]) for idx in members))
+        for idx in members:
+            split_name = get_split_name(documents[idx])
+            duplicate_nums[split_name] += 1
+            # a near-duplicate in another split of the same dataset
+            if any(other != split_name and other.split(":")[0] == documents[idx].dataset for other in split_names):
+                leaked_nums[split_name] += 1
+        for split_name1, split_name2 in itertools.combinations(split_names, 2):
+            overlap_nums[f"{split_name1} | {split_name2}"] += 1
+
+    splits = {split_name: dict(documents=document_num,
+                               duplicate_documents=duplicate_nums[split_name],
+                               leaked_documents=leaked_nums[split_name])
+              for split_name, document_num in sorted(split_document_nums.items())}
+    return dict(documents=len(documents),
+                clusters=len(clusters),
+                duplicate_documents=sum(len(members) for members in clusters),
+                splits=splits,
+                cross_split_overlaps=dict(sorted(overlap_nums.items(), key=lambda item: (-item[1], item[0]))))
+
+
+def write_clusters(documents, clusters, clusters_file):
+    with open(clusters_file, "w", encoding="utf-8") as f:
+        for members in sorted(clusters, key=lambda members: (-len(members), members[0])):
+            cluster = dict(size=len(members), members=[documents[idx].to_dict() for idx in members])
+            print(json.dumps(cluster, ensure_ascii=False), file=f)
+
+
+def main(args):
+    if args.num_perm % args.bands != 0:
+        raise ValueError(f"--num-perm {args.num_perm} is not divisible by --bands {args.bands}")
+    instrumentation = Instrumentation("near_duplicate", progress_interval=args.progress_interval,
+                                      report_file=args.report_file, profile_dir=args.profile_dir)
+
+    with instrumentation.stage("read"):
+        documents, texts = [], []
+        for document in read_all_documents(args):
+            text = normalize(document.text)
+            if len(text) < args.min_length:
+                instrumentation.count("documents_too_short")
+                continue
+            documents.append(document)
+            texts.append(text)
+        instrumentation.count("documents", len(documents))
+
+    with instrumentation.stage("minhash"):
+        signatures = compute_signatures(texts, args, instrumentation)
+
+    with instrumentation.stage("lsh"):
+        clusters = find_duplicates(signatures, args.bands, args.threshold, instrumentation,
+                                   max_pairwise_size=args.max_pairwise_bucket_size)
+
+    with instrumentation.stage("report"):
+        print(json.dumps(get_overlap_report(documents, clusters), ensure_ascii=False, indent=4))
+        if args.clusters_file is not None:
+            write_clusters(documents, clusters, args.clusters_file)
+
+    instrumentation.report()
+
+
+if __name__ == "__main__":
+    sys.stdin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+
+    parser = argparse.ArgumentParser(description="find near-duplicate texts within and across the splits of the datasets.")
+    parser.add_argument("--datasets-json", type=str, required=True, help="json for datasets")
+    parser.add_argument("--data-dir", type=str, required=True, help="data dir")
+    parser.add_argument("--datasets", nargs="*", default=None, help="dirnames of the datasets to check (default: all)")
+    parser.add_argument("--unit", choices=["record", "column"], default="record",
+                        help="record: a document per line with its columns joined, column: a document per column")
+    parser.add_argument("--ngram", type=int, default=5, help="character n-gram size")
+    parser.add_argument("--num-perm", type=int, default=128, help="number of minhash values per document")
+    parser.add_argument("--bands", type=int, default=16, help="number of LSH bands (num_perm / bands rows each)")
+    parser.add_argument("--threshold", type=float, default=0.8, help="estimated jaccard similarity of near-duplicates")
+    parser.add_argument("--max-pairwise-bucket-size", type=int, default=64,
+                        help="all the pairs of an LSH bucket up to this size are compared; larger buckets are compared "
+                             "against cluster representatives")
+    parser.add_argument("--min-length", type=int, default=10,
+                        help="documents shorter than this (after normalization) are skipped")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the minhash permutations")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes for computing the minhash signatures")
+    parser.add_argument("--batch-size", type=int, default=1000, help="number of documents sent to a worker at once")
+    parser.add_argument("--clusters-file", type=str, default=None,
+                        help="write the duplicate clusters with their texts as json lines")
+    parser.add_argument("--progress-interval", type=float, default=None,
+                        help="print a progress line to stderr every N seconds")
+    parser.add_argument("--report-file", type=str, default=None, help="write the final counters/timers report as json")
+    parser.add_argument("--profile-dir", type=str, default=None,
+                        help="write cProfile output of each stage under this dir (main process only)")
+    args = parser.parse_args()
+    main(args)